@@ -1,20 +1,29 @@
-import json
 from pathlib import Path
 from io import BytesIO
+import atexit
+import io
+import mmap
+import os
 import queue
+import threading
 import time
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import deque, namedtuple, OrderedDict
 #import multiprocessing.dummy as multiprocessing
 import random
 
 import numpy as np
-import openpyxl
 
 from psychopy import visual, core, event, gui #import some libraries from PsychoPy
 from psychopy.hardware import keyboard
 
 import aes
-from PIL import Image
+import dataset_key
+import encrypted_archive
+import results_backup
+import results_journal
+from PIL import Image, ImageOps
 
 WINDOW_SIZE = (1200, 800)
 IMAGE_SIZE = (1200, 400)
@@ -22,15 +31,23 @@ N_PROCESSES = 6
 MAX_QUEUE = N_PROCESSES
 ENCRYPTED_DATA_DIR = Path("encrypted_data")
 UNENCRYPTED_DATA_DIR = Path("data")
-BACKUP_RESULTS_DIR = Path("results_backup")
-BACKUP_RESULTS_DIR.mkdir(exist_ok=True, parents=True)
+BACKUP_RESULTS_FILE = Path("results_backup.sqlite")
+BACKUP_RESULTS_DIR = Path("results_backup")  # Backups of earlier versions, one JSON file per annotation
 PAUSE_SECONDS = 60*2  # The time of the pause in seconds
 PAUSE_DURATION_STEPS = 1
 N_ANNOTATIONS_BEFORE_PAUSE = 500  # How many annotations to do before enforcing pause
 TIME_BETWEEN_PAUSES = 60*25  # How much time to elapse between annotations
 ENFORCE_ANNOTATION_PAUSE = False  # Change this to True to block the program until PAUSE_SECONDS has elapsed
+VERIFY_DATA_ON_START = False  # Check the integrity of the files left to annotate before the session starts, which reads all of them
 
 TEXT_HEIGHT = 0.08
+CACHE_MAX_BYTES = 256 * 1024**2  # Memory budget for loaded images, including the ones kept for revisits
+STALL_PROBABILITY = 0.02  # Acceptable probability that the annotator has to wait for the next image
+TIMING_WINDOW = 50  # Number of recent load and decision times the prefetch distance is adapted to
+MIN_TIMING_SAMPLES = 5
+TIMING_SIMULATIONS = 2000
+MAX_DECISION_TIME = 60  # Seconds, a longer time between two images is a break and not used to adapt the prefetch distance
+PRINT_PREFETCH_STATS = False  # Print the wait, cache and prefetch statistics for every image
 
 def load_file(file, bytes_password, data_is_encrypted):
     if data_is_encrypted:
@@ -87,47 +104,355 @@ def decrypt_work_package(work_package):
     return image_path
 
 def decrypt_file(file_path, key):
+    decrypted_buffer = BytesIO()
     with open(file_path, 'rb') as fp:
-        encrypted_bytes = fp.read()
-    decrypted_bytes = aes.decrypt(key, encrypted_bytes)
-    return decrypted_bytes
+        aes.decrypt_stream(key, fp, decrypted_buffer)
+    return decrypted_buffer.getvalue()
 
-def load_encrypted_image(file_path, key):
-    decrypted_bytes = decrypt_file(file_path, key)
+def read_encrypted_bytes(file_path, archive_entry=None):
+    """Read the encrypted bytes of a file, or of its entry (archive_path, offset, length) in a dataset archive"""
+    if archive_entry is not None:
+        return encrypted_archive.read_entry(*archive_entry)
+    with open(file_path, 'rb') as fp:
+        return fp.read()
+
+def plan_file_decryption(file_path, key, archive_entry=None):
+    """Pool worker which reads the file, derives its key and checks its HMAC, see aes.plan_decryption"""
+    return aes.plan_decryption(key, read_encrypted_bytes(file_path, archive_entry))
+
+class ParallelDecryption:
+    """Decryption of a single file split over the whole process pool. A pool worker reads the file and authenticates 
+    it, then its chunks are decrypted by all workers, so the main thread does nothing but wait. Mirrors the parts of 
+    AsyncResult used by EncryptedDatasetItem. If load_times is given, the time from start to decrypted is appended 
+    to it."""
+    def __init__(self, file_path, key, process_pool, archive_entry=None, load_times=None):
+        self.process_pool = process_pool
+        self.load_times = load_times
+        self.started = threading.Event()
+        self.pending = None
+        self.error = None
+        self.t0 = time.perf_counter()
+        self.plan = process_pool.apply_async(plan_file_decryption, (file_path, key, archive_entry), 
+                                             callback=self._start, error_callback=lambda error: self.started.set())
+    
+    def _start(self, plan):
+        # Runs in the pool's result thread, where an exception would stop the pool from handling results
+        try:
+            function, work_packages, padded = plan
+            self.pending = aes.PendingDecryption(self.process_pool.map_async(function, work_packages, callback=self._finished), 
+                                                 padded)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.started.set()
+    
+    def _finished(self, chunks):
+        if self.load_times is not None:
+            self.load_times.append(time.perf_counter() - self.t0)
+    
+    def wait_started(self):
+        """Block until the chunks are in the pool's queue, or the file turned out not to be decryptable"""
+        self.started.wait()
+    
+    def ready(self):
+        return self.started.is_set() and (self.pending is None or self.pending.ready())
+    
+    def get(self, timeout=None):
+        self.plan.get(timeout)  # raises the error of the worker reading the file
+        self.started.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.pending.get(timeout)
+
+def decrypt_file_async(file_path, key, process_pool, archive_entry=None, load_times=None):
+    return ParallelDecryption(file_path, key, process_pool, archive_entry, load_times)
+
+def load_encrypted_image(file_path, key, archive_entry=None):
+    if archive_entry is not None:
+        decrypted_bytes = aes.decrypt(key, read_encrypted_bytes(file_path, archive_entry))
+    else:
+        decrypted_bytes = decrypt_file(file_path, key)
     # load audio here
     return decrypted_bytes
 
+# Shared memory blocks created by this worker process. On Windows a block is destroyed when its last handle is 
+# closed, so the worker keeps the handles of its most recent results open until the main process has attached. 
+# Elsewhere a block lives until it is unlinked, and a mapping kept here would hold its memory even after that.
+_worker_shared_memory = deque(maxlen=2*N_PROCESSES)
+
+# What a pool worker returns for a result in shared memory. Decrypted file bytes have no shape, pixel arrays have 
+# shape and dtype. load_time is the time the worker spent loading, not counting the time the task waited in the pool.
+SharedBlock = namedtuple('SharedBlock', ['name', 'size', 'shape', 'dtype', 'load_time'], defaults=(None, None, None))
+
+# PsychoPy converts numpy textures to float32 when uploading them, anything wider only costs memory and conversion
+PIXEL_DTYPE = np.float32
+
+def hand_over_shared_memory(shm, size, shape=None, dtype=None, load_time=None):
+    """Called by a worker when a shared memory block is filled, the main process then becomes its owner and releases 
+    it with release_shared_memory. The block stays registered with the resource tracker, which pool workers share 
+    with the main process. Unlinking it in the main process unregisters it, and the tracker unlinks any block that 
+    is still registered when the program exits."""
+    block = SharedBlock(shm.name, size, shape, dtype, load_time)
+    if os.name == 'nt':
+        _worker_shared_memory.append(shm)
+    else:
+        shm.close()
+    return block
+
+# Blocks which could not be closed yet since their memory is still referenced, e.g. by a stimulus
+_deferred_shared_memory = []
+
+def release_shared_memory(shm):
+    """Unlink and close a shared memory block received from a worker. If its buffer is still in use, closing is 
+    retried on later calls."""
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    _deferred_shared_memory.append(shm)
+    for deferred in list(_deferred_shared_memory):
+        try:
+            deferred.close()
+            _deferred_shared_memory.remove(deferred)
+        except BufferError:
+            pass
+
+
+# Results of items which were cleared while still loading, their shared memory is released once they arrive
+_abandoned_results = []
+
+def collect_abandoned_results(wait=False):
+    for result in list(_abandoned_results):
+        if wait or result.ready():
+            _abandoned_results.remove(result)
+            try:
+                block = result.get()
+            except Exception:
+                continue
+            if isinstance(block, SharedBlock):
+                release_shared_memory(shared_memory.SharedMemory(name=block.name))
+
+
+def fit_image(image):
+    """Shrink the image to fit IMAGE_SIZE, images are normally already that size from encryption"""
+    if image.width > IMAGE_SIZE[0] or image.height > IMAGE_SIZE[1]:
+        image = ImageOps.contain(image, IMAGE_SIZE)
+    return image
+
+def image_to_pixels(image, out=None):
+    """Convert a PIL image to the pixel array given to ImageStim: rows flipped since PsychoPy puts the origin at the 
+    bottom, values scaled to the 0--1 range of the rgb1 color space"""
+    pixels = np.asarray(fit_image(image))[::-1]
+    if out is None:
+        out = np.empty(pixels.shape, dtype=PIXEL_DTYPE)
+    np.divide(pixels, 255.0, out=out)
+    return out
+
+def load_image_pixels_shared(file_path, key, archive_entry=None):
+    """Pool worker which decrypts and decodes the image and writes its display-ready pixels (see image_to_pixels) to 
+    a new shared memory block. Returns a SharedBlock with the shape and dtype of the pixel array."""
+    t0 = time.perf_counter()
+    image = fit_image(Image.open(BytesIO(load_encrypted_image(file_path, key, archive_entry))))
+    shape = np.asarray(image).shape  # decodes the image
+    size = int(np.prod(shape)) * np.dtype(PIXEL_DTYPE).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        image_to_pixels(image, out=np.ndarray(shape, dtype=PIXEL_DTYPE, buffer=shm.buf))
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return hand_over_shared_memory(shm, size, shape, np.dtype(PIXEL_DTYPE).str, time.perf_counter() - t0)
+
+def load_encrypted_image_shared(file_path, key, archive_entry=None):
+    """Pool worker which memory maps the encrypted file, decrypts it into a new shared memory block and returns 
+    only a SharedBlock handle to it. The receiver is responsible for releasing it."""
+    t0 = time.perf_counter()
+    path, offset = (file_path, 0) if archive_entry is None else archive_entry[:2]
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as encrypted:
+        if aes.get_format_version(encrypted[offset:offset + aes.HEADER_SIZE]) == aes.VERSION_CHUNKED:
+            # Chunks are authenticated and decrypted one at a time straight into the shared block
+            encrypted.seek(offset)
+            reader = aes.EncryptedReader(key, encrypted)
+            size = reader.size
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            try:
+                reader.readinto(shm.buf[:size])
+            except BaseException:
+                shm.close()
+                shm.unlink()
+                raise
+        else:
+            length = len(encrypted) - offset if archive_entry is None else archive_entry[2]
+            decrypted_bytes = aes.decrypt(key, encrypted[offset:offset + length])
+            size = len(decrypted_bytes)
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            shm.buf[:size] = decrypted_bytes
+    return hand_over_shared_memory(shm, size, load_time=time.perf_counter() - t0)
+
+
+class MemoryReader(io.RawIOBase):
+    """Read-only file object over a buffer. Unlike BytesIO it doesn't copy the buffer, and closing it releases the 
+    buffer."""
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer).cast('B')
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(offset, 0)
+        return self._position
+    
+    def readinto(self, buffer):
+        data = self._buffer[self._position:self._position + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+    
+    def close(self):
+        self._buffer.release()
+        super().close()
+
 
 class EncryptedDatasetItem:
-    def __init__(self, file_path, key, process_pool: multiprocessing.Pool):
+    def __init__(self, file_path, key, process_pool: multiprocessing.Pool, archive_entry=None, prefetch_pixels=False, 
+                 load_times=None):
+        """If load_times is given, the time the worker spent loading is appended to it for every image loaded in the 
+        pool. Time waiting in the pool's queue is not counted, it grows with the prefetch distance itself."""
         self.file_path = file_path
         self.key = key
         self.process_pool = process_pool
+        self.archive_entry = archive_entry
+        self.prefetch_pixels = prefetch_pixels
+        self.load_times = load_times
         self.awaited = None
         self.bytes = None
+        self.pixels = None
+        self.shared_memory = None
     
-    def prefetch(self):
-        if self.bytes is None and self.awaited is None:
-            self.awaited = self.process_pool.apply_async(load_encrypted_image, (self.file_path, self.key))
+    def prefetch(self, parallel=False):
+        """Start loading the image. If parallel is True, the decryption of this single image is split over the 
+        whole process pool, which is useful when nothing else is being loaded. This blocks until its chunks are 
+        queued, so that anything prefetched afterwards is queued behind them."""
+        if not self.is_fetched() and self.awaited is None:
+            if parallel:
+                self.awaited = decrypt_file_async(self.file_path, self.key, self.process_pool, self.archive_entry, 
+                                                  self.load_times)
+                self.awaited.wait_started()
+                return
+            load = load_image_pixels_shared if self.prefetch_pixels else load_encrypted_image_shared
+            callback = None
+            if self.load_times is not None:
+                # Runs in the pool's result thread as soon as the result arrives
+                callback = lambda result: self.load_times.append(result.load_time)
+            self.awaited = self.process_pool.apply_async(load, (self.file_path, self.key, self.archive_entry), callback=callback)
     
-    def get_bytes(self):
-        if self.bytes is None:
+    def is_fetched(self):
+        return self.bytes is not None or self.pixels is not None
+    
+    def is_ready(self):
+        return self.is_fetched() or (self.awaited is not None and self.awaited.ready())
+    
+    def nbytes(self):
+        """Memory held by the loaded item, an item decrypted to bytes and then decoded holds both"""
+        nbytes = 0
+        if self.pixels is not None:
+            nbytes += self.pixels.nbytes
+        if self.bytes is not None:
+            nbytes += len(self.bytes)
+        return nbytes
+    
+    def fetch(self):
+        """Block until the item has been loaded"""
+        if not self.is_fetched():
             self.prefetch()
-            self.bytes = self.awaited.get()
-            self.awaited = None
+            self._receive(self.awaited.get())
+    
+    def is_loading(self):
+        return self.awaited is not None and not self.awaited.ready()
+    
+    def receive_if_ready(self):
+        """Take over the result if it has arrived, so nbytes() counts it. Errors are left to be raised by fetch()"""
+        if self.awaited is not None and self.awaited.ready():
+            try:
+                result = self.awaited.get()
+            except Exception:
+                return
+            self._receive(result)
+    
+    def get_bytes(self):
+        """Returns the decrypted bytes, as a memoryview of shared memory if they were decrypted by a pool worker. The 
+        view is only valid until clear() is called. Returns None if the item was prefetched as pixels."""
+        self.fetch()
         return self.bytes
     
+    def get_pixels(self):
+        """Returns the display-ready pixel array of the image, see image_to_pixels"""
+        self.fetch()
+        if self.pixels is None:
+            self.pixels = image_to_pixels(self.get_image())
+        return self.pixels
+    
+    def _receive(self, result):
+        self.awaited = None
+        if isinstance(result, SharedBlock):
+            self.shared_memory = shared_memory.SharedMemory(name=result.name)
+            if result.shape is None:
+                self.bytes = self.shared_memory.buf[:result.size]
+            else:
+                self.pixels = np.ndarray(result.shape, dtype=result.dtype, buffer=self.shared_memory.buf)
+        else:
+            self.bytes = result
+    
     def get_image(self):
-        audio_bytes = self.get_bytes()
-        audio_input_buffer = BytesIO(audio_bytes)
-        image = Image.open(audio_input_buffer)
+        """Decodes the image straight from the decrypted buffer, without copying it"""
+        image_reader = MemoryReader(self.get_bytes())
+        try:
+            image = Image.open(image_reader)
+            image.load()
+        finally:
+            # The reader holds an export of the shared buffer, which would keep the block from being closed
+            image_reader.close()
         return image
     
     def clear(self):
+        if self.awaited is not None:
+            if self.awaited.ready():
+                # Receive finished results so their shared memory is released
+                try:
+                    self._receive(self.awaited.get())
+                except Exception:
+                    pass
+            else:
+                _abandoned_results.append(self.awaited)
+        if isinstance(self.bytes, memoryview):
+            self.bytes.release()
         self.bytes = None
+        self.pixels = None
+        if self.shared_memory is not None:
+            release_shared_memory(self.shared_memory)
+            self.shared_memory = None
         self.awaited = None
 
-def discover_data(data_directory: Path, suffix_whitelist=('.jpeg', '.png', '.enc')):
+def discover_data(data_directory: Path, suffix_whitelist=('.jpeg', '.png', '.enc'), key=None):
+    """List the data files of the directory. If a key is given and the directory has a dataset archive, the files 
+    of the archive are listed instead (as paths in data_directory, which don't exist on disk)."""
+    archive_path = data_directory / encrypted_archive.ARCHIVE_FILE_NAME
+    if key is not None and archive_path.exists():
+        with encrypted_archive.ArchiveReader(archive_path, key) as archive:
+            return [data_directory / name for name in archive.names()]
     files = [file for file in data_directory.iterdir() if file.suffix in suffix_whitelist]
     # files_listing = data_directory / 'data_file.txt'
     # if files_listing.exists():
@@ -139,61 +464,199 @@ def discover_data(data_directory: Path, suffix_whitelist=('.jpeg', '.png', '.enc
     return files
 
 class EncryptedDataset:
-    def __init__(self, data_dir, password, num_processes=N_PROCESSES, prefetch_distance=N_PROCESSES, file_blacklist=None):
+    def __init__(self, data_dir, password, num_processes=N_PROCESSES, prefetch_distance=N_PROCESSES, file_blacklist=None, 
+                 prefetch_pixels=False, cache_max_bytes=CACHE_MAX_BYTES, stall_probability=STALL_PROBABILITY, 
+                 max_prefetch_distance=None):
+        """If prefetch_pixels is True the pool workers also decode the images, and get_pixels() returns arrays ready 
+        to display. Loaded items are kept in an LRU cache of at most cache_max_bytes, so recently shown items can be 
+        revisited without loading them again.
+        
+        prefetch_distance is where prefetching starts, it is then adapted to the measured load times and time 
+        between requests to the smallest distance where the next item is late with at most stall_probability. Set 
+        stall_probability to None to keep the prefetch distance fixed."""
         self.data_dir = data_dir
-        self.file_listing = discover_data(data_dir)
+        self.key = bytes(password, encoding='utf8')
+        archive_entries = dict()
+        archive_path = data_dir / encrypted_archive.ARCHIVE_FILE_NAME
+        if archive_path.exists():
+            # Only the index is read here, workers map the archive and read their items as slices of it
+            with encrypted_archive.ArchiveReader(archive_path, self.key) as archive:
+                self.file_listing = [data_dir / name for name in archive.names()]
+                archive_entries = {name: (archive_path, *archive.entry(name)) for name in archive.names()}
+        else:
+            self.file_listing = discover_data(data_dir)
         if file_blacklist is not None:
             self.file_listing = [file for file in self.file_listing if file.name not in file_blacklist]
-        self.key = bytes(password, encoding='utf8')
         self.num_processes = num_processes
         self.prefetch_distance = prefetch_distance
-        self.pool = multiprocessing.Pool(self.num_processes)
-        self.dataset_items = [EncryptedDatasetItem(file_path, self.key, self.pool) for file_path in self.file_listing]
+        self.stall_probability = stall_probability
+        self.max_prefetch_distance = max_prefetch_distance if max_prefetch_distance is not None else 4*num_processes
+        self.load_times = deque(maxlen=TIMING_WINDOW)
+        self.decision_times = deque(maxlen=TIMING_WINDOW)
+        self.last_request_time = None
+        self.stalls = 0
+        self.rng = np.random.default_rng()
+        initializer, initargs = None, ()
+        keycheck_file = data_dir / aes.KEYCHECK_FILE_NAME
+        if keycheck_file.exists():
+            # The key of the dataset is derived once here, and not again by every worker
+            dataset_salt = aes.get_keycheck_salt(keycheck_file.read_bytes())
+            initializer, initargs = aes.add_master_key, (self.key, dataset_salt, aes.get_master_key(self.key, dataset_salt))
+        # Forked workers only share the resource tracker of the main process if it is already running
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(self.num_processes, initializer, initargs)
+        # Shut down before multiprocessing terminates the pool at exit, after which abandoned results never arrive
+        atexit.register(self.shutdown_pool)
+        self.dataset_items = [EncryptedDatasetItem(file_path, self.key, self.pool, archive_entries.get(file_path.name), prefetch_pixels, 
+                                                   self.load_times) 
+                              for file_path in self.file_listing]
+        self.cache_max_bytes = cache_max_bytes
+        self.cached = OrderedDict()  # index -> bytes of the item when last seen, least recently used first
+        self.cached_bytes = 0
+        self.unsized = set()  # Cached indices whose size may still change, since they are loading or were just fetched
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
         
     def __len__(self):
         return len(self.file_listing)
     
-    def __getitem__(self, index):
-        for i in range(index):
-            self.dataset_items[i].clear()
-            
+    def get_item(self, index):
+        collect_abandoned_results()
+        if self.last_request_time is not None:
+            decision_time = time.time() - self.last_request_time
+            # Longer intervals are breaks, they would make the prefetch distance too short for the annotator at work
+            if decision_time <= MAX_DECISION_TIME:
+                self.decision_times.append(decision_time)
+        self.adapt_prefetch_distance()
+        item = self.dataset_items[index]
+        if item.is_ready():
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            if item.is_loading():
+                self.stalls += 1
         self.prefetch(index)    
         t0 = time.time()
-        bytes = self.dataset_items[index].get_bytes()  # will block if bytes has not been read
-        print(f"Bytes took {time.time()-t0}s to read")
-        return bytes
+        item.fetch()  # will block if the item has not been read
+        if PRINT_PREFETCH_STATS:
+            print(f"Bytes took {time.time()-t0}s to read "
+                  f"(cache hits: {self.cache_hits}, misses: {self.cache_misses}, evictions: {self.cache_evictions}, "
+                  f"size: {self.cached_bytes/1024**2:.1f}MB, prefetch distance: {self.prefetch_distance}, stalls: {self.stalls})")
+        self._touch(index)
+        self._enforce_cache_budget(range(index, index + self.prefetch_distance + 1))
+        self.unsized.add(index)  # get_pixels may decode it after this, it is counted again on the next access
+        self.last_request_time = time.time()
+        return item
+    
+    def pause(self):
+        """Call when the annotator takes a pause, the time until the next request is then not a decision time"""
+        self.last_request_time = None
+    
+    def adapt_prefetch_distance(self):
+        """
+        Sets the prefetch distance to the smallest one where the item needed next is still loading with at most 
+        stall_probability. An item prefetched d items ahead has the time of d decisions to load, the probability that 
+        this is shorter than its load time is estimated by resampling the recently measured times.
+        """
+        if (self.stall_probability is None or len(self.load_times) < MIN_TIMING_SAMPLES 
+                or len(self.decision_times) < MIN_TIMING_SAMPLES):
+            return
+        load_times = self.rng.choice(np.array(self.load_times), TIMING_SIMULATIONS)
+        decision_times = self.rng.choice(np.array(self.decision_times), (TIMING_SIMULATIONS, self.max_prefetch_distance))
+        time_until_needed = np.cumsum(decision_times, axis=1)  # Column d-1 is the time an item d ahead has to load
+        stall_probabilities = (time_until_needed < load_times[:, None]).mean(axis=0)
+        acceptable_distances = np.flatnonzero(stall_probabilities <= self.stall_probability)
+        if len(acceptable_distances) > 0:
+            self.prefetch_distance = int(acceptable_distances[0]) + 1
+        else:
+            self.prefetch_distance = self.max_prefetch_distance
+    
+    def __getitem__(self, index):
+        return bytes(self.get_item(index).get_bytes())
     
     def get_image(self, index):
-        image_bytes = self[index]
-        return image_from_bytes(image_bytes)
+        return self.get_item(index).get_image()
+    
+    def get_pixels(self, index):
+        return self.get_item(index).get_pixels()
 
     def get_file_name(self, index):
         return self.dataset_items[index].file_path
     
     def cache(self, index):
         """Initiate a prefectch of the given index. The encryption latency will be hidden since it's likely done ahead of time"""
-        pass
+        self.dataset_items[index].prefetch()
+        self._touch(index)
+        self.unsized.add(index)
     
     def evict(self, index):
         """If the given index has been cached, destroy the cached object"""
-        pass
+        self.dataset_items[index].clear()
+        self.unsized.discard(index)
+        if index in self.cached:
+            self.cached_bytes -= self.cached.pop(index)
+    
+    def _touch(self, index):
+        """Mark the index as most recently used and update its size, which is known once it has been fetched"""
+        nbytes = self.dataset_items[index].nbytes()
+        self.cached_bytes += nbytes - self.cached.get(index, 0)
+        self.cached[index] = nbytes
+        self.cached.move_to_end(index)
+    
+    def _update_cache_sizes(self):
+        """Count the size of the items which may have changed since they were last counted, the rest of the cache 
+        is not visited. Items are counted until they are no longer loading."""
+        for index in list(self.unsized):
+            item = self.dataset_items[index]
+            item.receive_if_ready()
+            self.cached_bytes += item.nbytes() - self.cached[index]
+            self.cached[index] = item.nbytes()
+            if not item.is_loading():
+                self.unsized.discard(index)
+    
+    def _enforce_cache_budget(self, protected):
+        """Evict least recently used items until the cache fits its budget, never evicting the protected indices"""
+        self._update_cache_sizes()
+        while self.cached_bytes > self.cache_max_bytes:
+            # The protected items were touched last, so the search stops at the first items of the cache
+            index = next((index for index in self.cached if index not in protected), None)
+            if index is None:
+                break
+            self.evict(index)
+            self.cache_evictions += 1
     
     def shutdown_pool(self):
+        if self.pool is None:
+            return
+        atexit.unregister(self.shutdown_pool)
         self.pool.close()
         self.pool.join()
+        # All work is done now, release the shared memory of every result
+        for index in list(self.cached):
+            self.evict(index)
+        collect_abandoned_results(wait=True)
+        self.pool = None
         
     def __del__(self):
         self.shutdown_pool()
     
     def shuffle(self, seed=1729):
+        # Indices change meaning, so start over with an empty cache
+        for index in list(self.cached):
+            self.evict(index)
         random.seed(seed)
         random.shuffle(self.dataset_items)
         self.prefetch()
             
     def prefetch(self, index=0):
+        # Everything that is loading has been prefetched, and is therefore among the unsized items of the cache
+        if index < len(self) and not any(self.dataset_items[i].is_loading() for i in self.unsized):
+            # The pool is idle (e.g. right after startup), let all processes work on the image we need first
+            self.dataset_items[index].prefetch(parallel=True)
         for i in range(index, index + self.prefetch_distance + 1):
             if i < len(self):
-                self.dataset_items[i].prefetch()
+                self.cache(i)
         
 
 def image_from_bytes(image_bytes):
@@ -203,19 +666,13 @@ def image_from_bytes(image_bytes):
 
 
 def test_decrypt(file_directory: Path, password):
-    key = bytes(password, encoding='utf8')
-    file_listing = discover_data(file_directory)
-    try:
-        decrypt_file(file_listing[0], key)
-        return True
-    except AssertionError:
-        return False
-    # except InvalidToken:
-    #     return False
+    """Check the password against the keycheck file of the dataset, or against the HMAC of the first file if 
+    there is none. Neither needs any image to be decrypted. Raises an AssertionError if the keycheck file is not 
+    valid."""
+    return dataset_key.check_password(file_directory, bytes(password, encoding='utf8'))
 
 
 def main():
-    data_files = discover_data(ENCRYPTED_DATA_DIR)
     ## Ask for decryption key
     data_is_encrypted = True
     data_read_success = False
@@ -229,28 +686,27 @@ def main():
             password, = thisInfo
             bytes_password = bytes(password, encoding='utf8')
             
-            if test_decrypt(ENCRYPTED_DATA_DIR, password):
-                data_read_success = True
-            else:
-                gui.warnDlg(title="Felaktigt lösenord", prompt=f"Lösenordet som angavs kunde inte avkryptera filen {data_files[0]} , vänligen försök igen.")
+            try:
+                data_read_success = test_decrypt(ENCRYPTED_DATA_DIR, password)
+            except AssertionError:
+                gui.warnDlg(title="Ogiltig nyckelkontroll", 
+                            prompt=f"Filen {ENCRYPTED_DATA_DIR / aes.KEYCHECK_FILE_NAME} är skadad, inget lösenord kan kontrolleras mot den.")
+                core.quit()
+            if not data_read_success:
+                gui.warnDlg(title="Felaktigt lösenord", prompt=f"Lösenordet som angavs kunde inte avkryptera filerna i {ENCRYPTED_DATA_DIR} , vänligen försök igen.")
         else:
             #mywin.close()
             core.quit()
             
+    data_files = discover_data(ENCRYPTED_DATA_DIR, key=bytes_password)
         
     partial_results_file = Path("partial_results.xlsx")
+    # Every annotation is appended to the journal, the workbook is only written at pauses and on exit
+    results_journal_file = Path("partial_results.jsonl")
 
-    fieldnames = ["file", 'annotation', 'n_changes', 'decision_time']
-
-    annotations = dict()
-    if partial_results_file.exists():
-        wb = openpyxl.load_workbook(filename = partial_results_file)
-        ws = wb.active
-        rows = list(ws.iter_rows())
-        # We assume the first row is the header
-        for file, annotation, n_changes, decision_time in rows[1:]:
-            annotations[file.value] = {'file': file.value, 'annotation': annotation.value, 'n_changes': n_changes.value, 'decision_time': decision_time.value}
-        wb.close()
+    t0 = time.time()
+    annotations = results_journal.load_annotations(results_journal_file, partial_results_file)
+    print(f"Loaded {len(annotations)} previous annotations in {time.time()-t0:.3f}s")
 
     if annotations:
         dlg_prev = gui.Dlg(title="Fortsätt med existerande annoteringar")
@@ -268,13 +724,37 @@ def main():
                 dlg_prev.addText(f"Ange \"OK\" för radera tidigare annoteringar eller \"Cancel\" för att fortsätta utan att radera")
                 prev_info = dlg_prev.show()
                 if prev_info is not None:
-                    partial_results_file.unlink()
+                    results_journal.delete_annotations(results_journal_file, partial_results_file)
                     annotations = dict()
         else:
             core.quit() 
             
-    dataset = EncryptedDataset(ENCRYPTED_DATA_DIR, password, file_blacklist=set(annotations.keys()))
+    file_blacklist = set(annotations.keys())
+    if VERIFY_DATA_ON_START:
+        # Imported here since it needs tqdm, which the annotator otherwise does without
+        import verify_data_no_gui
+        # A file which can't be decrypted is found now instead of in the middle of the session
+        t0 = time.time()
+        problems = verify_data_no_gui.verify_dataset(ENCRYPTED_DATA_DIR, bytes_password, 
+                                                     names={file.name for file in data_files} - file_blacklist)
+        print(f"Verified the data in {time.time()-t0:.2f}s")
+        if problems:
+            problem_list = "\n".join(f"{name}: {problem}" for name, problem in sorted(problems.items())[:10])
+            if len(problems) > 10:
+                problem_list += "\n..."
+            gui.warnDlg(title="Skadade filer", 
+                        prompt=f"{len(problems)} filer i {ENCRYPTED_DATA_DIR} är skadade och kommer att hoppas över:\n{problem_list}")
+            file_blacklist |= set(problems)
+            
+    dataset = EncryptedDataset(ENCRYPTED_DATA_DIR, password, file_blacklist=file_blacklist, prefetch_pixels=True)
     dataset.shuffle()
+    # Saves results in the background, everything submitted is written before the program exits
+    new_backup = not BACKUP_RESULTS_FILE.exists()
+    backup_store = results_backup.BackupStore(BACKUP_RESULTS_FILE)
+    if new_backup and BACKUP_RESULTS_DIR.exists():
+        for backup_file, reason in backup_store.import_json_directory(BACKUP_RESULTS_DIR):
+            print(f"Skipped the backup {backup_file}: {reason}")
+    results_writer = results_journal.ResultsWriter(results_journal_file, partial_results_file, backup_store)
 
     #create a window
     mywin = visual.Window(WINDOW_SIZE, monitor="testMonitor", units="deg")
@@ -310,9 +790,13 @@ def main():
     annotations_since_last_pause = 0
     last_pause_time = time.time()
     
+    # One image stimulus is created for the first trial and then reused, only its texture is updated
+    image_stim = None
+    
     for i in range(n_images):
         elapsed_since_pause = time.time() - last_pause_time
         if (annotations_since_last_pause > N_ANNOTATIONS_BEFORE_PAUSE) or (elapsed_since_pause > TIME_BETWEEN_PAUSES):
+            results_writer.save_workbook(annotations)
             if ENFORCE_ANNOTATION_PAUSE:
                 mywin.color = (0, 0, 0)
                 mywin.flip()
@@ -397,19 +881,22 @@ def main():
                     
             annotations_since_last_pause = 0
             last_pause_time = time.time()
+            dataset.pause()
         
         
-        pil_image = dataset.get_image(i)
+        image_arr = dataset.get_pixels(i)  # decoded, flipped and scaled to 0--1 (float32) by the prefetch workers
         file = dataset.get_file_name(i)
-        image_arr = np.array(pil_image, order="C")  # convert to numpy array with shape width, height, channels
-        image_arr = (image_arr.astype(float) / 255.0)  # convert to float in 0--1 range, assuming image is 8-bit uint.
         height, width = image_arr.shape[:2]
-        image_stim = visual.ImageStim(mywin, 
-                                    image_arr[::-1],
-                                    units="pix",
-                                    pos=(0, 0),
-                                    size=(width, height),  # here's a gotcha: need to pass the size (x, y) explicitly.
-                                    colorSpace="rgb1")  # img_as_float converts to 0:1 range, whereas PsychoPy defaults to -1:1.
+        if image_stim is None:
+            image_stim = visual.ImageStim(mywin, 
+                                        image_arr,
+                                        units="pix",
+                                        pos=(0, 0),
+                                        size=(width, height),  # here's a gotcha: need to pass the size (x, y) explicitly.
+                                        colorSpace="rgb1")  # img_as_float converts to 0:1 range, whereas PsychoPy defaults to -1:1.
+        else:
+            image_stim.image = image_arr  # uploads into the existing texture
+            image_stim.size = (width, height)
         
         annotation_stim.text = ""
         mywin.color = (.2, .2, .2)
@@ -433,6 +920,8 @@ def main():
                 if key_name in annotation_commands:
                     if annotation != key_name:
                         n_changes += 1
+                        results_writer.append_change({'file': file.name, 'annotation': key_name, 'n_changes': n_changes, 
+                                                      'decision_time': trialClock.getTime()})
                     annotation = key_name
                     annotation_data = annotation_commands[key_name]
                     annotation_stim.text = f"Din notering: {annotation_data['name']}\nTryck 'enter' för att bekräfta."
@@ -458,39 +947,26 @@ def main():
         decision_time = trialClock.getTime()
         annotation_result = {'file': file.name, 'annotation': annotation, 'n_changes': n_changes, 'decision_time': decision_time}
         annotations[file.name] = annotation_result
-        
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.append(fieldnames)
-        for file_name, record in annotations.items():
-            row = [record[fieldname] for fieldname in fieldnames]
-            ws.append(row)
-        wb.save(partial_results_file)
-        backup_results_file = BACKUP_RESULTS_DIR / file.with_suffix('.json').name
-        with open(backup_results_file ,'w') as backup_results_fp:
-            json.dump(annotation_result, backup_results_fp)
+        results_writer.append(annotation_result)
             
         annotations_since_last_pause += 1
         # with open(partial_results_file, 'a', newline='') as partial_results_fp:
         #     csv_writer = csv.DictWriter(partial_results_fp, fieldnames=fieldnames)
         #     csv_writer.writerow({'file': file.name, 'annotation': annotation, 'n_changes': n_changes, 'decision_time': decision_time})
+    
+    results_writer.save_workbook(annotations)
         
     if set([f.name for f in data_files]).issubset(annotations.keys()):
         file_save_results = gui.fileSaveDlg(prompt="Välj fil att exportera resultat till",initFileName="results.xlsx", allowed='Excel files (*.xlsx)|*.xlsx')
         if file_save_results is None:
             gui.infoDlg(title="Resultat sparades inte", prompt=f"Resultatet sparades inte, kör programmet igen (dina annoteringar har sparats) och välj fil att spara till.")
         else:
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.append(fieldnames)
-            for file_name, record in annotations.items():
-                row = [record[fieldname] for fieldname in fieldnames]
-                ws.append(row)
-            wb.save(file_save_results)
+            results_writer.save_workbook(annotations, file_save_results)
             #trials.saveAsExcel(file_save_results, dataOut=('all_raw',), fileCollisionMethod='overwrite')
     else:
         gui.infoDlg(title="Ofullständigt resultat", prompt=f"Alla filer har inte annoterats. Du kan fortsätta annotera de kvarvarande genom att köra programmet igen.")
 
+    results_writer.close()
     mywin.close()
     core.quit()
 
@@ -11,8 +11,45 @@ Other block modes contributed by @righthandabacus.
 
 Although this is an exercise, the `encrypt` and `decrypt` functions should
 provide reasonable security to encrypted messages.
+
+If NumPy is available, modes where blocks can be processed independently of
+each other (CBC and CFB decryption, CTR) run on a vectorized engine that
+handles the whole message as one array of blocks. The output is byte-for-byte
+identical to the pure Python implementation, which is used when NumPy is
+missing.
+
+Encrypted messages come in two formats, told apart by their first bytes:
+
+- Version 1: `hmac + salt + ciphertext`. The AES key, HMAC key and IV are
+  stretched from the password and the salt with PBKDF2.
+- Version 2: `MAGIC + version + hmac + dataset_salt + salt + ciphertext`. A
+  master key is stretched once with PBKDF2 from the password and the
+  dataset salt, which is shared by every file encrypted in the same run, and
+  the per-file keys are derived from it and the file salt with HKDF. Since
+  derived keys are cached, a dataset pays for one key stretch per process.
+
+In both formats the ciphertext is AES-128-CBC with PKCS#7 padding and the
+HMAC-SHA256 covers everything that follows it (and the header for version 2).
+
+- Version 3 (chunked): `MAGIC + version + dataset_salt + salt + chunk_size +
+  plaintext_size + header_hmac`, followed by the plaintext encrypted with
+  AES-128-CTR in chunks of `chunk_size` bytes, each followed by its own
+  HMAC. Keys are derived as in version 2. Since every chunk is
+  authenticated on its own and the CTR counter of any chunk is known, any
+  part of the plaintext can be read without touching the rest, see
+  `EncryptedReader`.
 """
 
+import io
+import multiprocessing
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 s_box = (
     0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
@@ -122,6 +159,36 @@ r_con = (
 )
 
 
+def _gmul(a, b):
+    """ Multiplies two bytes in GF(2^8). """
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        a = xtime(a)
+        b >>= 1
+    return product
+
+
+def _make_t_tables(box, coefficients):
+    """
+    Builds the four T-tables combining `box` lookups with one MixColumns (or
+    InvMixColumns) column given by `coefficients`. Table i is table 0 rotated
+    right by i bytes.
+    """
+    table = tuple(int.from_bytes(bytes(_gmul(box[x], c) for c in coefficients), 'big') for x in range(256))
+    rotated = [table]
+    for _ in range(3):
+        rotated.append(tuple(((t >> 8) | (t << 24)) & 0xFFFFFFFF for t in rotated[-1]))
+    return tuple(rotated)
+
+
+# Precomputed round tables for the 32-bit word implementation, with state
+# columns packed big-endian (row 0 in the most significant byte).
+Te0, Te1, Te2, Te3 = _make_t_tables(s_box, (2, 1, 1, 3))
+Td0, Td1, Td2, Td3 = _make_t_tables(inv_s_box, (14, 9, 13, 11))
+
+
 def bytes2matrix(text):
     """ Converts a 16-byte array into a 4x4 matrix.  """
     return [list(text[i:i+4]) for i in range(0, len(text), 4)]
@@ -171,6 +238,68 @@ def split_blocks(message, block_size=16, require_padding=True):
         return [message[i:i+16] for i in range(0, len(message), block_size)]
 
 
+if np is not None:
+    # Lookup tables for the vectorized engine. The state of each block is kept
+    # in the same column-major byte order as `bytes2matrix`, so byte 4*c + r
+    # is row r of column c.
+    _np_s_box = np.array(s_box, dtype=np.uint8)
+    _np_inv_s_box = np.array(inv_s_box, dtype=np.uint8)
+    _np_xtime = np.array([xtime(a) for a in range(256)], dtype=np.uint8)
+    _np_shift_rows = np.array([4*((c + r) % 4) + r for c in range(4) for r in range(4)])
+    _np_inv_shift_rows = np.array([4*((c - r) % 4) + r for c in range(4) for r in range(4)])
+
+
+def _np_mix_columns(state):
+    """ Vectorized `mix_columns` over an (n, 16) array of states. """
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    t = a0 ^ a1 ^ a2 ^ a3
+    out = np.empty_like(s)
+    out[:, :, 0] = a0 ^ t ^ _np_xtime[a0 ^ a1]
+    out[:, :, 1] = a1 ^ t ^ _np_xtime[a1 ^ a2]
+    out[:, :, 2] = a2 ^ t ^ _np_xtime[a2 ^ a3]
+    out[:, :, 3] = a3 ^ t ^ _np_xtime[a3 ^ a0]
+    return out.reshape(-1, 16)
+
+
+def _np_inv_mix_columns(state):
+    """ Vectorized `inv_mix_columns` over an (n, 16) array of states. """
+    s = state.reshape(-1, 4, 4).copy()
+    u = _np_xtime[_np_xtime[s[:, :, 0] ^ s[:, :, 2]]]
+    v = _np_xtime[_np_xtime[s[:, :, 1] ^ s[:, :, 3]]]
+    s[:, :, 0] ^= u
+    s[:, :, 1] ^= v
+    s[:, :, 2] ^= u
+    s[:, :, 3] ^= v
+    return _np_mix_columns(s)
+
+
+def _as_block_array(blocks):
+    """ Returns `blocks` (bytes-like or array) as an (n, 16) uint8 array. """
+    if isinstance(blocks, np.ndarray):
+        blocks = blocks.astype(np.uint8, copy=False)
+    else:
+        blocks = np.frombuffer(blocks, dtype=np.uint8)
+    assert blocks.size % 16 == 0, "Blocks must be made of full 16-byte blocks."
+    return blocks.reshape(-1, 16)
+
+
+def _np_counter_blocks(iv, n_blocks):
+    """
+    Returns the `n_blocks` CTR nonces starting at `iv`, as produced by
+    repeatedly calling `inc_bytes`, as an (n, 16) uint8 array.
+    """
+    high = int.from_bytes(iv[:8], 'big')
+    low = int.from_bytes(iv[8:], 'big')
+    lows = np.uint64(low) + np.arange(n_blocks, dtype=np.uint64)
+    # The low word wrapped around for every counter smaller than the start.
+    highs = np.uint64(high) + (lows < np.uint64(low)).astype(np.uint64)
+    counters = np.empty((n_blocks, 2), dtype='>u8')
+    counters[:, 0] = highs
+    counters[:, 1] = lows
+    return counters.view(np.uint8).reshape(-1, 16)
+
+
 class AES:
     """
     Class for AES-128 encryption with CBC mode and PKCS#7.
@@ -179,13 +308,29 @@ class AES:
     management. Unless you need that, please use `encrypt` and `decrypt`.
     """
     rounds_by_key_size = {16: 10, 24: 12, 32: 14}
-    def __init__(self, master_key):
+    scalar_backends = ('ttable', 'matrix')
+    def __init__(self, master_key, use_numpy=True, scalar_backend='ttable'):
         """
         Initializes the object with a given key.
+
+        If `use_numpy` is true and NumPy is installed, modes with independent
+        blocks use the vectorized engine (see `encrypt_blocks`).
+
+        `scalar_backend` selects how single blocks are processed: 'ttable'
+        works on packed 32-bit words with precomputed round tables, 'matrix'
+        is the original byte-by-byte implementation.
         """
         assert len(master_key) in AES.rounds_by_key_size
+        assert scalar_backend in AES.scalar_backends
         self.n_rounds = AES.rounds_by_key_size[len(master_key)]
-        self._key_matrices = self._expand_key(master_key)
+        self.scalar_backend = scalar_backend
+        self._master_key = bytes(master_key)
+        self._key_matrices, self._key_words = self._expand_key(master_key)
+        self._inv_key_words = self._invert_key_words(self._key_words)
+        self.use_numpy = use_numpy and np is not None
+        if self.use_numpy:
+            self._round_keys = np.array([[b for column in matrix for b in column]
+                                         for matrix in self._key_matrices], dtype=np.uint8)
 
     def _expand_key(self, master_key):
         """
@@ -219,7 +364,77 @@ class AES:
             key_columns.append(word)
 
         # Group key words in 4x4 byte matrices.
-        return [key_columns[4*i : 4*(i+1)] for i in range(len(key_columns) // 4)]
+        key_matrices = [key_columns[4*i : 4*(i+1)] for i in range(len(key_columns) // 4)]
+        # And pack them as 32-bit words for the T-table implementation.
+        key_words = [int.from_bytes(bytes(column), 'big') for column in key_columns]
+        return key_matrices, key_words
+
+    def _invert_key_words(self, key_words):
+        """
+        Returns the decryption key schedule for the T-table implementation:
+        the round keys in reverse order, with InvMixColumns applied to all
+        but the first and last round.
+        """
+        inv_key_words = list(key_words[-4:])
+        for i in range(self.n_rounds - 1, 0, -1):
+            for w in key_words[4*i : 4*(i+1)]:
+                # Td tables include the inverse S-box, cancel it out.
+                inv_key_words.append(Td0[s_box[w >> 24]] ^ Td1[s_box[(w >> 16) & 0xFF]] ^
+                                     Td2[s_box[(w >> 8) & 0xFF]] ^ Td3[s_box[w & 0xFF]])
+        inv_key_words.extend(key_words[:4])
+        return inv_key_words
+
+    def _encrypt_words(self, s0, s1, s2, s3):
+        """
+        Encrypts a single block given as four big-endian 32-bit column words.
+        """
+        rk = self._key_words
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+
+        k = 4
+        for _ in range(self.n_rounds - 1):
+            t0 = Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^ Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ rk[k]
+            t1 = Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^ Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ rk[k + 1]
+            t2 = Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^ Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ rk[k + 2]
+            t3 = Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^ Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ rk[k + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+            k += 4
+
+        # Last round has no MixColumns.
+        S = s_box
+        return ((S[s0 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 | S[(s2 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ rk[k],
+                (S[s1 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 | S[(s3 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ rk[k + 1],
+                (S[s2 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 | S[(s0 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ rk[k + 2],
+                (S[s3 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 | S[(s1 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ rk[k + 3])
+
+    def _decrypt_words(self, s0, s1, s2, s3):
+        """
+        Decrypts a single block given as four big-endian 32-bit column words.
+        """
+        rk = self._inv_key_words
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+
+        k = 4
+        for _ in range(self.n_rounds - 1):
+            t0 = Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^ Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ rk[k]
+            t1 = Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^ Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ rk[k + 1]
+            t2 = Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^ Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ rk[k + 2]
+            t3 = Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^ Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ rk[k + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+            k += 4
+
+        # Last round has no InvMixColumns.
+        S = inv_s_box
+        return ((S[s0 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 | S[(s2 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ rk[k],
+                (S[s1 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 | S[(s3 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ rk[k + 1],
+                (S[s2 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 | S[(s0 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ rk[k + 2],
+                (S[s3 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 | S[(s1 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ rk[k + 3])
 
     def encrypt_block(self, plaintext):
         """
@@ -227,6 +442,9 @@ class AES:
         """
         assert len(plaintext) == 16
 
+        if self.scalar_backend == 'ttable':
+            return struct.pack('>4I', *self._encrypt_words(*struct.unpack('>4I', plaintext)))
+
         plain_state = bytes2matrix(plaintext)
 
         add_round_key(plain_state, self._key_matrices[0])
@@ -249,6 +467,9 @@ class AES:
         """
         assert len(ciphertext) == 16
 
+        if self.scalar_backend == 'ttable':
+            return struct.pack('>4I', *self._decrypt_words(*struct.unpack('>4I', ciphertext)))
+
         cipher_state = bytes2matrix(ciphertext)
 
         add_round_key(cipher_state, self._key_matrices[-1])
@@ -265,14 +486,75 @@ class AES:
 
         return matrix2bytes(cipher_state)
 
+    def encrypt_blocks(self, blocks):
+        """
+        Encrypts a batch of independent 16 byte blocks with the vectorized
+        engine. `blocks` can be a bytes-like object with a length multiple of
+        16 or an array of shape (n, 16). Returns an (n, 16) uint8 array.
+        """
+        assert np is not None, "The vectorized engine requires NumPy."
+        state = _as_block_array(blocks) ^ self._round_keys[0]
+
+        for i in range(1, self.n_rounds):
+            state = _np_s_box[state[:, _np_shift_rows]]
+            state = _np_mix_columns(state)
+            state ^= self._round_keys[i]
+
+        state = _np_s_box[state[:, _np_shift_rows]]
+        state ^= self._round_keys[-1]
+
+        return state
+
+    def decrypt_blocks(self, blocks):
+        """
+        Decrypts a batch of independent 16 byte blocks with the vectorized
+        engine. `blocks` can be a bytes-like object with a length multiple of
+        16 or an array of shape (n, 16). Returns an (n, 16) uint8 array.
+        """
+        assert np is not None, "The vectorized engine requires NumPy."
+        state = _as_block_array(blocks) ^ self._round_keys[-1]
+        state = _np_inv_s_box[state[:, _np_inv_shift_rows]]
+
+        for i in range(self.n_rounds - 1, 0, -1):
+            state ^= self._round_keys[i]
+            state = _np_inv_mix_columns(state)
+            state = _np_inv_s_box[state[:, _np_inv_shift_rows]]
+
+        state ^= self._round_keys[0]
+
+        return state
+
+    def _keystream_xor(self, data, counters):
+        """
+        XORs `data` with the encryption of the (n, 16) array `counters`,
+        truncating the keystream to the length of `data`.
+        """
+        keystream = self.encrypt_blocks(counters).reshape(-1)[:len(data)]
+        return (np.frombuffer(data, dtype=np.uint8) ^ keystream).tobytes()
+
     def encrypt_cbc(self, plaintext, iv):
         """
         Encrypts `plaintext` using CBC mode and PKCS#7 padding, with the given
         initialization vector (iv).
         """
-        assert len(iv) == 16
+        return self._encrypt_cbc_blocks(pad(plaintext), iv)
 
-        plaintext = pad(plaintext)
+    def _encrypt_cbc_blocks(self, plaintext, iv):
+        """
+        Encrypts already padded `plaintext` using CBC mode.
+        """
+        assert len(iv) == 16
+        assert len(plaintext) % 16 == 0
+
+        if self.scalar_backend == 'ttable':
+            words = struct.unpack(f'>{len(plaintext) // 4}I', plaintext)
+            p0, p1, p2, p3 = struct.unpack('>4I', iv)
+            encrypt_words = self._encrypt_words
+            out = []
+            for i in range(0, len(words), 4):
+                p0, p1, p2, p3 = encrypt_words(words[i] ^ p0, words[i + 1] ^ p1, words[i + 2] ^ p2, words[i + 3] ^ p3)
+                out += (p0, p1, p2, p3)
+            return struct.pack(f'>{len(out)}I', *out)
 
         blocks = []
         previous = iv
@@ -289,8 +571,31 @@ class AES:
         Decrypts `ciphertext` using CBC mode and PKCS#7 padding, with the given
         initialization vector (iv).
         """
+        return unpad(self._decrypt_cbc_blocks(ciphertext, iv))
+
+    def _decrypt_cbc_blocks(self, ciphertext, iv):
+        """
+        Decrypts `ciphertext` using CBC mode, leaving the padding in place.
+        """
         assert len(iv) == 16
 
+        if self.use_numpy:
+            ciphertext_blocks = _as_block_array(ciphertext)
+            previous = np.concatenate([_as_block_array(iv), ciphertext_blocks[:-1]])
+            return (self.decrypt_blocks(ciphertext_blocks) ^ previous).tobytes()
+
+        if self.scalar_backend == 'ttable':
+            assert len(ciphertext) % 16 == 0
+            words = struct.unpack(f'>{len(ciphertext) // 4}I', ciphertext)
+            c0, c1, c2, c3 = struct.unpack('>4I', iv)
+            decrypt_words = self._decrypt_words
+            out = []
+            for i in range(0, len(words), 4):
+                d0, d1, d2, d3 = decrypt_words(*words[i:i + 4])
+                out += (d0 ^ c0, d1 ^ c1, d2 ^ c2, d3 ^ c3)
+                c0, c1, c2, c3 = words[i:i + 4]
+            return struct.pack(f'>{len(out)}I', *out)
+
         blocks = []
         previous = iv
         for ciphertext_block in split_blocks(ciphertext):
@@ -298,7 +603,30 @@ class AES:
             blocks.append(xor_bytes(previous, self.decrypt_block(ciphertext_block)))
             previous = ciphertext_block
 
-        return unpad(b''.join(blocks))
+        return b''.join(blocks)
+
+    def decrypt_cbc_parallel(self, ciphertext, iv, workers=None, pool=None):
+        """
+        Decrypts `ciphertext` like `decrypt_cbc`, but split into chunks that
+        are decrypted in `pool` (a multiprocessing pool), or in a pool of
+        `workers` processes created for this call.
+
+        CBC decryption of a block only needs the previous ciphertext block,
+        so each chunk is decrypted independently with the last block of the
+        preceding chunk as its IV.
+        """
+        if pool is None:
+            with multiprocessing.Pool(workers) as pool:
+                return self.decrypt_cbc_parallel_async(ciphertext, iv, pool, workers).get()
+        return self.decrypt_cbc_parallel_async(ciphertext, iv, pool, workers).get()
+
+    def decrypt_cbc_parallel_async(self, ciphertext, iv, pool, workers=None):
+        """
+        Starts a chunked CBC decryption of `ciphertext` in `pool` and returns
+        a `PendingDecryption`, whose `get()` returns the unpadded plaintext.
+        """
+        work_packages = _cbc_work_packages(self._master_key, ciphertext, iv, workers)
+        return PendingDecryption(pool.map_async(_decrypt_cbc_chunk, work_packages))
 
     def encrypt_pcbc(self, plaintext, iv):
         """
@@ -362,6 +690,12 @@ class AES:
         """
         assert len(iv) == 16
 
+        if self.use_numpy:
+            # Every previous ciphertext block is known up front.
+            n_blocks = (len(ciphertext) + 15) // 16
+            previous = (bytes(iv) + bytes(ciphertext))[:16 * n_blocks]
+            return self._keystream_xor(ciphertext, _as_block_array(previous))
+
         blocks = []
         prev_ciphertext = iv
         for ciphertext_block in split_blocks(ciphertext, require_padding=False):
@@ -412,6 +746,9 @@ class AES:
         """
         assert len(iv) == 16
 
+        if self.use_numpy:
+            return self._keystream_xor(plaintext, _np_counter_blocks(iv, (len(plaintext) + 15) // 16))
+
         blocks = []
         nonce = iv
         for plaintext_block in split_blocks(plaintext, require_padding=False):
@@ -428,6 +765,9 @@ class AES:
         """
         assert len(iv) == 16
 
+        if self.use_numpy:
+            return self._keystream_xor(ciphertext, _np_counter_blocks(iv, (len(ciphertext) + 15) // 16))
+
         blocks = []
         nonce = iv
         for ciphertext_block in split_blocks(ciphertext, require_padding=False):
@@ -439,7 +779,54 @@ class AES:
         return b''.join(blocks)
 
 
-import os
+# Chunks smaller than this are not worth shipping to another process.
+MIN_PARALLEL_CHUNK_SIZE = 64 * 1024
+
+
+def _cbc_work_packages(master_key, ciphertext, iv, workers=None):
+    """
+    Splits a CBC decryption into work packages for `_decrypt_cbc_chunk`,
+    at most one per worker.
+    """
+    assert len(iv) == 16
+    assert len(ciphertext) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
+
+    n_blocks = len(ciphertext) // 16
+    n_chunks = min(workers or os.cpu_count() or 1, -(-len(ciphertext) // MIN_PARALLEL_CHUNK_SIZE))
+    blocks_per_chunk = -(-n_blocks // max(n_chunks, 1))
+
+    work_packages = []
+    for start in range(0, n_blocks, blocks_per_chunk):
+        chunk_iv = iv if start == 0 else ciphertext[16*(start-1) : 16*start]
+        chunk = ciphertext[16*start : 16*(start + blocks_per_chunk)]
+        work_packages.append((master_key, chunk, chunk_iv))
+    return work_packages
+
+
+def _decrypt_cbc_chunk(work_package):
+    """ Pool worker for `AES.decrypt_cbc_parallel`. """
+    master_key, ciphertext, iv = work_package
+    return AES(master_key)._decrypt_cbc_blocks(ciphertext, iv)
+
+
+class PendingDecryption:
+    """
+    Handle to a decryption running in a process pool. Mirrors the parts of
+    `multiprocessing.pool.AsyncResult` used by callers.
+    """
+    def __init__(self, async_result, padded=True):
+        self._async_result = async_result
+        self._padded = padded
+
+    def ready(self):
+        return self._async_result.ready()
+
+    def get(self, timeout=None):
+        plaintext = b''.join(self._async_result.get(timeout))
+        return unpad(plaintext) if self._padded else plaintext
+
+
+from functools import lru_cache
 from hashlib import pbkdf2_hmac
 from hmac import new as new_hmac, compare_digest
 
@@ -449,24 +836,162 @@ IV_SIZE = 16
 
 SALT_SIZE = 16
 HMAC_SIZE = 32
+MASTER_KEY_SIZE = 32
+
+# Versioned messages start with MAGIC and a version byte. Version 1 messages
+# have no header and start directly with their HMAC, so a version 1 message is
+# only misread if its HMAC happens to start with these five bytes.
+MAGIC = b'ACFE'
+VERSION_SESSION_KEY = 2
+VERSION_CHUNKED = 3
+SUPPORTED_VERSIONS = (VERSION_SESSION_KEY, VERSION_CHUNKED)
+HEADER_SIZE = len(MAGIC) + 1
+
+# Number of derived keys kept in memory by each process.
+KEY_CACHE_SIZE = 256
+
+# Master keys derived by another process, see `add_master_key`.
+_known_master_keys = {}
+
 
+class DecryptionError(AssertionError):
+    """
+    Raised for messages which cannot be decrypted. It is an AssertionError,
+    which is what callers catch for a wrong key.
+    """
+
+
+class TruncatedError(DecryptionError):
+    """ The message is shorter than its format requires. """
+
+
+class AuthenticationError(DecryptionError):
+    """ The HMAC does not match, the message is corrupt or the key is wrong. """
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
 def get_key_iv(password, salt, workload=100000):
     """
     Stretches the password and extracts an AES key, an HMAC key and an AES
     initialization vector.
     """
     stretched = pbkdf2_hmac('sha256', password, salt, workload, AES_KEY_SIZE + IV_SIZE + HMAC_KEY_SIZE)
+    return _split_key_material(stretched)
+
+
+def _split_key_material(stretched):
     aes_key, stretched = stretched[:AES_KEY_SIZE], stretched[AES_KEY_SIZE:]
     hmac_key, stretched = stretched[:HMAC_KEY_SIZE], stretched[HMAC_KEY_SIZE:]
     iv = stretched[:IV_SIZE]
     return aes_key, hmac_key, iv
 
 
-def encrypt(key, plaintext, workload=100000):
+def hkdf(key_material, salt, info, length):
+    """
+    HKDF-SHA256 (RFC 5869): extracts a pseudorandom key from `key_material`
+    and `salt` and expands it to `length` bytes bound to `info`.
+    """
+    prk = new_hmac(salt, key_material, 'sha256').digest()
+    output = b''
+    block = b''
+    counter = 1
+    while len(output) < length:
+        block = new_hmac(prk, block + info + bytes([counter]), 'sha256').digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def get_master_key(password, dataset_salt, workload=100000):
+    """
+    Stretches the password into the master key shared by all version 2 files
+    with the same dataset salt.
+    """
+    master_key = _known_master_keys.get((password, dataset_salt, workload))
+    if master_key is None:
+        master_key = pbkdf2_hmac('sha256', password, dataset_salt, workload, MASTER_KEY_SIZE)
+    return master_key
+
+
+def add_master_key(password, dataset_salt, master_key, workload=100000):
+    """
+    Makes `get_master_key` return `master_key` without stretching the
+    password. Used as a pool initializer, so the workers do not each derive
+    a key the parent process has already derived.
+    """
+    _known_master_keys[(password, dataset_salt, workload)] = master_key
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def get_session_key_iv(password, dataset_salt, salt, workload=100000):
+    """
+    Derives the AES key, HMAC key and IV of a version 2 file from the master
+    key of its dataset and its own salt.
+    """
+    master_key = get_master_key(password, dataset_salt, workload)
+    stretched = hkdf(master_key, salt, b'acroface file key', AES_KEY_SIZE + IV_SIZE + HMAC_KEY_SIZE)
+    return _split_key_material(stretched)
+
+
+def get_format_version(ciphertext):
+    """
+    Returns the format version of an encrypted message.
+    """
+    if ciphertext[:len(MAGIC)] == MAGIC and len(ciphertext) > len(MAGIC) and ciphertext[len(MAGIC)] in SUPPORTED_VERSIONS:
+        return ciphertext[len(MAGIC)]
+    return 1
+
+
+def get_dataset_salt(ciphertext):
+    """
+    Returns the dataset salt of an encrypted message, or None for version 1
+    messages which have none.
+    """
+    version = get_format_version(ciphertext)
+    if version == VERSION_SESSION_KEY:
+        return bytes(ciphertext[HEADER_SIZE + HMAC_SIZE : HEADER_SIZE + HMAC_SIZE + SALT_SIZE])
+    if version == VERSION_CHUNKED:
+        return bytes(ciphertext[HEADER_SIZE : HEADER_SIZE + SALT_SIZE])
+    return None
+
+
+def _new_message_keys(key, workload, dataset_salt):
+    """
+    Draws a new salt and returns the header, salt field, AES key, HMAC key
+    and IV of a new message. See `encrypt`.
+    """
+    salt = os.urandom(SALT_SIZE)
+    if dataset_salt is None:
+        return (b'', salt) + get_key_iv(key, salt, workload)
+    assert len(dataset_salt) == SALT_SIZE
+    header = MAGIC + bytes([VERSION_SESSION_KEY])
+    return (header, dataset_salt + salt) + get_session_key_iv(key, dataset_salt, salt, workload)
+
+
+def _salt_field_size(version):
+    return 2 * SALT_SIZE if version == VERSION_SESSION_KEY else SALT_SIZE
+
+
+def _message_keys(key, version, salt_field, workload):
+    """
+    Returns the AES key, HMAC key and IV for a message with the given
+    version and salt field.
+    """
+    if version == VERSION_SESSION_KEY:
+        return get_session_key_iv(key, salt_field[:SALT_SIZE], salt_field[SALT_SIZE:], workload)
+    return get_key_iv(key, salt_field, workload)
+
+
+def encrypt(key, plaintext, workload=100000, dataset_salt=None):
     """
     Encrypts `plaintext` with `key` using AES-128, an HMAC to verify integrity,
     and PBKDF2 to stretch the given key.
 
+    If `dataset_salt` is given, the message is written in the version 2
+    format where the key stretch is shared by all files with the same
+    dataset salt. Otherwise the version 1 format is used.
+
     The exact algorithm is specified in the module docstring.
     """
     if isinstance(key, str):
@@ -474,13 +999,45 @@ def encrypt(key, plaintext, workload=100000):
     if isinstance(plaintext, str):
         plaintext = plaintext.encode('utf-8')
 
-    salt = os.urandom(SALT_SIZE)
-    key, hmac_key, iv = get_key_iv(key, salt, workload)
+    header, salt, key, hmac_key, iv = _new_message_keys(key, workload, dataset_salt)
     ciphertext = AES(key).encrypt_cbc(plaintext, iv)
-    hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
+    hmac = new_hmac(hmac_key, header + salt + ciphertext, 'sha256').digest()
     assert len(hmac) == HMAC_SIZE
 
-    return hmac + salt + ciphertext
+    return header + hmac + salt + ciphertext
+
+
+def _authenticate(key, ciphertext, workload):
+    """
+    Checks the HMAC of `ciphertext` and returns the AES key, IV and the
+    CBC ciphertext body.
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    version = get_format_version(ciphertext)
+    header = ciphertext[:HEADER_SIZE] if version != 1 else b''
+    ciphertext = ciphertext[len(header):]
+
+    if len(ciphertext) % 16 != 0:
+        raise TruncatedError("Ciphertext must be made of full 16-byte blocks.")
+
+    if len(ciphertext) < 32:
+        raise TruncatedError("""
+    Ciphertext must be at least 32 bytes long (16 byte salt + 16 byte block). To
+    encrypt or decrypt single blocks use `AES(key).decrypt_block(ciphertext)`.
+    """)
+
+    salt_size = _salt_field_size(version)
+    hmac, ciphertext = ciphertext[:HMAC_SIZE], ciphertext[HMAC_SIZE:]
+    salt, ciphertext = ciphertext[:salt_size], ciphertext[salt_size:]
+    key, hmac_key, iv = _message_keys(key, version, salt, workload)
+
+    expected_hmac = new_hmac(hmac_key, header + salt + ciphertext, 'sha256').digest()
+    if not compare_digest(hmac, expected_hmac):
+        raise AuthenticationError('Ciphertext corrupted or tampered.')
+
+    return key, iv, ciphertext
 
 
 def decrypt(key, ciphertext, workload=100000):
@@ -490,25 +1047,431 @@ def decrypt(key, ciphertext, workload=100000):
 
     The exact algorithm is specified in the module docstring.
     """
+    if get_format_version(ciphertext) == VERSION_CHUNKED:
+        return EncryptedReader(key, io.BytesIO(ciphertext), workload).readall()
+    key, iv, ciphertext = _authenticate(key, ciphertext, workload)
+    return AES(key).decrypt_cbc(ciphertext, iv)
 
-    assert len(ciphertext) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
 
-    assert len(ciphertext) >= 32, """
-    Ciphertext must be at least 32 bytes long (16 byte salt + 16 byte block). To
-    encrypt or decrypt single blocks use `AES(key).decrypt_block(ciphertext)`.
+def decrypt_parallel(key, ciphertext, workload=100000, workers=None, pool=None):
+    """
+    Like `decrypt`, but splits the AES decryption over a process pool. See
+    `AES.decrypt_cbc_parallel`.
+    """
+    if pool is None:
+        with multiprocessing.Pool(workers) as pool:
+            return decrypt_async(key, ciphertext, pool, workload, workers).get()
+    return decrypt_async(key, ciphertext, pool, workload, workers).get()
+
+
+def decrypt_async(key, ciphertext, pool, workload=100000, workers=None):
+    """
+    Authenticates `ciphertext` in the calling process and starts decrypting
+    it in chunks over `pool`. Returns a `PendingDecryption`.
+    """
+    function, work_packages, padded = plan_decryption(key, ciphertext, workload, workers)
+    return PendingDecryption(pool.map_async(function, work_packages), padded)
+
+
+def plan_decryption(key, ciphertext, workload=100000, workers=None):
+    """
+    Authenticates `ciphertext` and splits its decryption into work packages,
+    at most one per worker. Returns the pool worker function, the work
+    packages and whether the joined plaintext is padded. Lets a pool worker
+    do the key derivation and HMAC of `decrypt_async`.
+    """
+    if get_format_version(ciphertext) == VERSION_CHUNKED:
+        reader = EncryptedReader(key, io.BytesIO(ciphertext), workload)
+        return _decrypt_ctr_chunk, reader.work_packages(workers), False
+    key, iv, ciphertext = _authenticate(key, ciphertext, workload)
+    return _decrypt_cbc_chunk, _cbc_work_packages(key, ciphertext, iv, workers), True
+
+
+def authenticate(key, ciphertext, workload=100000):
+    """
+    Checks that `ciphertext` is authentic under `key`, raising a
+    `TruncatedError` or `AuthenticationError` saying why if it is not. Only
+    the key derivation and the HMAC are computed, no AES decryption is done.
+    """
+    if get_format_version(ciphertext) == VERSION_CHUNKED:
+        EncryptedReader(key, io.BytesIO(ciphertext), workload).verify()
+    else:
+        _authenticate(key, ciphertext, workload)
+
+
+def verify(key, ciphertext, workload=100000):
     """
+    Returns True if `ciphertext` is authentic under `key`. See `authenticate`.
+    """
+    try:
+        authenticate(key, ciphertext, workload)
+    except DecryptionError:
+        return False
+    return True
+
 
+# A keycheck is a small file stored next to a version 2 dataset, allowing a
+# password to be checked with a single key stretch and without touching any
+# data file: MAGIC + version + dataset_salt + check value derived from the
+# master key.
+KEYCHECK_FILE_NAME = 'dataset.keycheck'
+KEYCHECK_SIZE = 16
+
+
+def create_keycheck(key, dataset_salt, workload=100000):
+    """
+    Returns the keycheck for `key` and the dataset salt used to encrypt a
+    dataset.
+    """
     if isinstance(key, str):
         key = key.encode('utf-8')
+    master_key = get_master_key(key, dataset_salt, workload)
+    check_value = hkdf(master_key, dataset_salt, b'acroface key check', KEYCHECK_SIZE)
+    return MAGIC + bytes([VERSION_SESSION_KEY]) + dataset_salt + check_value
 
-    hmac, ciphertext = ciphertext[:HMAC_SIZE], ciphertext[HMAC_SIZE:]
-    salt, ciphertext = ciphertext[:SALT_SIZE], ciphertext[SALT_SIZE:]
-    key, hmac_key, iv = get_key_iv(key, salt, workload)
 
-    expected_hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
-    assert compare_digest(hmac, expected_hmac), 'Ciphertext corrupted or tampered.'
+def get_keycheck_salt(keycheck):
+    """
+    Returns the dataset salt stored in a keycheck. Raises an AssertionError
+    if `keycheck` is not one, e.g. if the file has been truncated.
+    """
+    assert len(keycheck) == HEADER_SIZE + SALT_SIZE + KEYCHECK_SIZE, 'Not a keycheck.'
+    assert keycheck[:HEADER_SIZE] == MAGIC + bytes([VERSION_SESSION_KEY]), 'Not a keycheck.'
+    return keycheck[HEADER_SIZE : HEADER_SIZE + SALT_SIZE]
+
 
-    return AES(key).decrypt_cbc(ciphertext, iv)
+def check_key(key, keycheck, workload=100000):
+    """
+    Returns True if `key` is the key the keycheck was created with. See
+    `get_keycheck_salt` for keychecks which are malformed.
+    """
+    expected = create_keycheck(key, get_keycheck_salt(keycheck), workload)
+    return compare_digest(keycheck, expected)
+
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_chunks(fp, chunk_size):
+    """
+    Yields `chunk_size` byte chunks from `fp` until it is exhausted. Only the
+    last chunk can be shorter, even if `fp.read` returns short reads.
+    """
+    buffer = b''
+    while True:
+        data = fp.read(chunk_size - len(buffer))
+        if not data:
+            break
+        buffer += data
+        if len(buffer) == chunk_size:
+            yield buffer
+            buffer = b''
+    if buffer:
+        yield buffer
+
+
+def encrypt_stream(key, in_fp, out_fp, chunk_size=STREAM_CHUNK_SIZE, workload=100000, dataset_salt=None):
+    """
+    Encrypts everything read from the binary file object `in_fp` into
+    `out_fp`, `chunk_size` bytes at a time, producing the same format as
+    `encrypt`. Since the HMAC is stored in front of the ciphertext, `out_fp`
+    must be seekable.
+    """
+    assert chunk_size % 16 == 0, "Chunk size must be a multiple of 16 bytes."
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    header, salt, key, hmac_key, iv = _new_message_keys(key, workload, dataset_salt)
+    cipher = AES(key)
+    hmac = new_hmac(hmac_key, header + salt, 'sha256')
+
+    out_fp.write(header)
+    hmac_position = out_fp.tell()
+    out_fp.write(bytes(HMAC_SIZE))
+    out_fp.write(salt)
+
+    previous = iv
+    chunk = b''
+    for next_chunk in _read_chunks(in_fp, chunk_size):
+        if chunk:
+            ciphertext = cipher._encrypt_cbc_blocks(chunk, previous)
+            hmac.update(ciphertext)
+            out_fp.write(ciphertext)
+            previous = ciphertext[-16:]
+        chunk = next_chunk
+    # The last chunk gets the padding, even if it is empty.
+    ciphertext = cipher._encrypt_cbc_blocks(pad(chunk), previous)
+    hmac.update(ciphertext)
+    out_fp.write(ciphertext)
+
+    end_position = out_fp.tell()
+    out_fp.seek(hmac_position)
+    out_fp.write(hmac.digest())
+    out_fp.seek(end_position)
+
+
+def decrypt_stream(key, in_fp, out_fp, chunk_size=STREAM_CHUNK_SIZE, workload=100000):
+    """
+    Decrypts a message produced by `encrypt` or `encrypt_stream` from the
+    binary file object `in_fp` into `out_fp`, `chunk_size` bytes at a time.
+
+    The HMAC is checked in a first pass over the ciphertext, so nothing is
+    written unless the message is authentic. `in_fp` must be seekable.
+    """
+    assert chunk_size % 16 == 0, "Chunk size must be a multiple of 16 bytes."
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    header = in_fp.read(HEADER_SIZE)
+    version = get_format_version(header)
+    if version == VERSION_CHUNKED:
+        in_fp.seek(-len(header), os.SEEK_CUR)
+        reader = EncryptedReader(key, in_fp, workload)
+        reader.verify()
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            out_fp.write(chunk)
+        return
+    if version == 1:
+        # Not a header, rewind to the HMAC.
+        in_fp.seek(-len(header), os.SEEK_CUR)
+        header = b''
+
+    hmac = in_fp.read(HMAC_SIZE)
+    salt = in_fp.read(_salt_field_size(version))
+    if len(salt) != _salt_field_size(version):
+        raise TruncatedError("Ciphertext is truncated.")
+    key, hmac_key, iv = _message_keys(key, version, salt, workload)
+
+    body_position = in_fp.tell()
+    expected_hmac = new_hmac(hmac_key, header + salt, 'sha256')
+    body_size = 0
+    for chunk in _read_chunks(in_fp, chunk_size):
+        expected_hmac.update(chunk)
+        body_size += len(chunk)
+    if not compare_digest(hmac, expected_hmac.digest()):
+        raise AuthenticationError('Ciphertext corrupted or tampered.')
+    if body_size % 16 != 0 or body_size == 0:
+        raise TruncatedError("Ciphertext must be made of full 16-byte blocks.")
+
+    in_fp.seek(body_position)
+    cipher = AES(key)
+    previous = iv
+    plaintext = b''
+    for chunk in _read_chunks(in_fp, chunk_size):
+        out_fp.write(plaintext)
+        plaintext = cipher._decrypt_cbc_blocks(chunk, previous)
+        previous = chunk[-16:]
+    out_fp.write(unpad(plaintext))
+
+
+CONTAINER_CHUNK_SIZE = 64 * 1024
+_CHUNKED_HEADER = struct.Struct(f'>{HEADER_SIZE}s{SALT_SIZE}s{SALT_SIZE}sIQ')
+
+
+def _add_counter(iv, n_blocks):
+    """ Returns the CTR nonce `n_blocks` increments after `iv`. """
+    return ((int.from_bytes(iv, 'big') + n_blocks) % (1 << 128)).to_bytes(16, 'big')
+
+
+def _chunk_tag(hmac_key, header_hmac, index, ciphertext):
+    return new_hmac(hmac_key, header_hmac + struct.pack('>Q', index) + ciphertext, 'sha256').digest()
+
+
+def encrypt_chunked_stream(key, in_fp, out_fp, chunk_size=CONTAINER_CHUNK_SIZE, workload=100000, dataset_salt=None):
+    """
+    Encrypts everything read from `in_fp` into `out_fp` in the chunked
+    (version 3) format, one chunk at a time. The header is written last, so
+    `out_fp` must be seekable.
+    """
+    assert chunk_size % 16 == 0, "Chunk size must be a multiple of 16 bytes."
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    if dataset_salt is None:
+        dataset_salt = os.urandom(SALT_SIZE)
+    assert len(dataset_salt) == SALT_SIZE
+
+    salt = os.urandom(SALT_SIZE)
+    aes_key, hmac_key, iv = get_session_key_iv(key, dataset_salt, salt, workload)
+    cipher = AES(aes_key)
+
+    header_position = out_fp.tell()
+    out_fp.write(bytes(_CHUNKED_HEADER.size + HMAC_SIZE))
+
+    # The header HMAC binds the chunk tags, so it is computed before the
+    # chunks. It only depends on the plaintext size, which needs a first pass.
+    start_position = in_fp.tell()
+    plaintext_size = in_fp.seek(0, os.SEEK_END) - start_position
+    in_fp.seek(start_position)
+    header = _CHUNKED_HEADER.pack(MAGIC + bytes([VERSION_CHUNKED]), dataset_salt, salt, chunk_size, plaintext_size)
+    header_hmac = new_hmac(hmac_key, header, 'sha256').digest()
+
+    for index, chunk in enumerate(_read_chunks(in_fp, chunk_size)):
+        ciphertext = cipher.encrypt_ctr(chunk, _add_counter(iv, index * chunk_size // 16))
+        out_fp.write(ciphertext)
+        out_fp.write(_chunk_tag(hmac_key, header_hmac, index, ciphertext))
+    assert in_fp.tell() - start_position == plaintext_size, "Input changed size while encrypting."
+
+    end_position = out_fp.tell()
+    out_fp.seek(header_position)
+    out_fp.write(header + header_hmac)
+    out_fp.seek(end_position)
+
+
+def encrypt_chunked(key, plaintext, chunk_size=CONTAINER_CHUNK_SIZE, workload=100000, dataset_salt=None):
+    """
+    Encrypts `plaintext` in the chunked (version 3) format. See
+    `encrypt_chunked_stream`.
+    """
+    if isinstance(plaintext, str):
+        plaintext = plaintext.encode('utf-8')
+    out = io.BytesIO()
+    encrypt_chunked_stream(key, io.BytesIO(plaintext), out, chunk_size, workload, dataset_salt)
+    return out.getvalue()
+
+
+def _decrypt_ctr_chunk(work_package):
+    """ Pool worker for `EncryptedReader.decrypt_async`. """
+    aes_key, counter, ciphertext = work_package
+    return AES(aes_key).decrypt_ctr(ciphertext, counter)
+
+
+class EncryptedReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a message in the chunked (version 3)
+    format stored in the binary file object `fp`, starting at its current
+    position.
+
+    Only the chunks overlapping what is read are authenticated and decrypted,
+    so e.g. `PIL.Image.open` can read the header of an image without
+    decrypting the whole file. Wrap it in `io.BufferedReader` for many small
+    reads.
+    """
+    def __init__(self, key, fp, workload=100000):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        self._fp = fp
+        self._start = fp.tell()
+
+        header = fp.read(_CHUNKED_HEADER.size)
+        header_hmac = fp.read(HMAC_SIZE)
+        if len(header_hmac) != HMAC_SIZE:
+            raise TruncatedError("Ciphertext is truncated.")
+        magic, dataset_salt, salt, self.chunk_size, self.size = _CHUNKED_HEADER.unpack(header)
+        assert magic == MAGIC + bytes([VERSION_CHUNKED]), "Not a chunked message."
+
+        self._aes_key, self._hmac_key, self._iv = get_session_key_iv(key, dataset_salt, salt, workload)
+        expected_hmac = new_hmac(self._hmac_key, header, 'sha256').digest()
+        if not compare_digest(header_hmac, expected_hmac):
+            raise AuthenticationError('Ciphertext corrupted or tampered.')
+        self._header_hmac = header_hmac
+        self._cipher = AES(self._aes_key)
+
+        self.n_chunks = -(-self.size // self.chunk_size)
+        self._position = 0
+        self._chunk_index = None
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def _read_chunk_ciphertext(self, index):
+        """
+        Reads and authenticates the ciphertext of chunk `index`.
+        """
+        length = min(self.chunk_size, self.size - index * self.chunk_size)
+        self._fp.seek(self._start + _CHUNKED_HEADER.size + HMAC_SIZE + index * (self.chunk_size + HMAC_SIZE))
+        ciphertext = self._fp.read(length)
+        tag = self._fp.read(HMAC_SIZE)
+        if len(ciphertext) != length or len(tag) != HMAC_SIZE:
+            raise TruncatedError("Ciphertext is truncated.")
+        expected_tag = _chunk_tag(self._hmac_key, self._header_hmac, index, ciphertext)
+        if not compare_digest(tag, expected_tag):
+            raise AuthenticationError('Ciphertext corrupted or tampered.')
+        return ciphertext
+
+    def read_chunk(self, index):
+        """
+        Returns the plaintext of chunk `index`.
+        """
+        if index != self._chunk_index:
+            ciphertext = self._read_chunk_ciphertext(index)
+            self._chunk = self._cipher.decrypt_ctr(ciphertext, _add_counter(self._iv, index * self.chunk_size // 16))
+            self._chunk_index = index
+        return self._chunk
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        n_read = 0
+        while n_read < len(buffer) and self._position < self.size:
+            index, offset = divmod(self._position, self.chunk_size)
+            data = self.read_chunk(index)[offset : offset + len(buffer) - n_read]
+            buffer[n_read : n_read + len(data)] = data
+            n_read += len(data)
+            self._position += len(data)
+        return n_read
+
+    def readall(self):
+        if self._position >= self.size:
+            return b''
+        first_index, offset = divmod(self._position, self.chunk_size)
+        data = b''.join([self.read_chunk(first_index)[offset:]] +
+                        [self.read_chunk(index) for index in range(first_index + 1, self.n_chunks)])
+        self._position = self.size
+        return data
+
+    def verify(self):
+        """
+        Authenticates every chunk without decrypting anything. Raises a
+        `DecryptionError` if any chunk is corrupted or missing.
+        """
+        for index in range(self.n_chunks):
+            self._read_chunk_ciphertext(index)
+        end = self._start + _CHUNKED_HEADER.size + HMAC_SIZE + self.size + self.n_chunks * HMAC_SIZE
+        if self._fp.seek(0, os.SEEK_END) != end:
+            raise DecryptionError("Ciphertext has trailing data.")
+
+    def decrypt_async(self, pool, workers=None):
+        """
+        Authenticates every chunk in the calling process and starts
+        decrypting them in `pool`. Returns a `PendingDecryption`.
+        """
+        return PendingDecryption(pool.map_async(_decrypt_ctr_chunk, self.work_packages(workers)), padded=False)
+
+    def work_packages(self, workers=None):
+        """
+        Authenticates every chunk and groups them into work packages for
+        `_decrypt_ctr_chunk`, at most one per worker.
+        """
+        self.verify()
+        n_groups = min(workers or os.cpu_count() or 1, -(-self.size // MIN_PARALLEL_CHUNK_SIZE))
+        chunks_per_group = max(-(-self.n_chunks // max(n_groups, 1)), 1)
+        work_packages = []
+        for first in range(0, self.n_chunks, chunks_per_group):
+            indices = range(first, min(first + chunks_per_group, self.n_chunks))
+            ciphertext = b''.join(self._read_chunk_ciphertext(index) for index in indices)
+            counter = _add_counter(self._iv, first * self.chunk_size // 16)
+            work_packages.append((self._aes_key, counter, ciphertext))
+        return work_packages
 
 
 def benchmark():
@@ -518,7 +1481,9 @@ def benchmark():
     for i in range(30000):
         aes.encrypt_block(message)
 
-__all__ = ["encrypt", "decrypt", "AES"]
+__all__ = ["encrypt", "decrypt", "decrypt_parallel", "decrypt_async", "plan_decryption", "encrypt_stream", "decrypt_stream",
+           "verify", "authenticate", "create_keycheck", "check_key", "add_master_key", "get_dataset_salt", "encrypt_chunked", "encrypt_chunked_stream",
+           "EncryptedReader", "AES", "DecryptionError", "TruncatedError", "AuthenticationError"]
 
 if __name__ == '__main__':
     import sys
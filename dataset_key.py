@@ -0,0 +1,35 @@
+"""
+Checks of a password against an encrypted dataset. None of them needs any
+image to be decrypted, so they are quick enough to run before anything else,
+e.g. when the annotator asks for the password.
+"""
+from pathlib import Path
+
+import aes
+import encrypted_archive
+
+
+def check_archive_key(archive_path: Path, key):
+    """Returns True if the index of the archive decrypts with key"""
+    try:
+        encrypted_archive.ArchiveReader(archive_path, key).close()
+        return True
+    except AssertionError:
+        return False
+
+
+def check_password(encrypted_dir: Path, key, data_files=None):
+    """
+    Checks the key against the keycheck of the dataset, or if it has none against its archive index or the HMAC of
+    its first file, or the first of data_files if given. Raises an AssertionError if the keycheck file is not a
+    valid keycheck, then no key can be checked against it.
+    """
+    keycheck_file = encrypted_dir / aes.KEYCHECK_FILE_NAME
+    if keycheck_file.exists():
+        return aes.check_key(key, keycheck_file.read_bytes())
+    archive_path = encrypted_dir / encrypted_archive.ARCHIVE_FILE_NAME
+    if archive_path.exists():
+        return check_archive_key(archive_path, key)
+    if data_files is None:
+        data_files = sorted(file for file in encrypted_dir.iterdir() if file.suffix == '.enc')
+    return not data_files or aes.verify(key, data_files[0].read_bytes())
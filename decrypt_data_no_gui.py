@@ -4,41 +4,193 @@ import argparse
 import importlib
 import multiprocessing
 import sys
+from collections import deque
+from fnmatch import fnmatch
+import io
 from pathlib import Path
-
+import tarfile
+import time
+import zipfile
 
 import os
 
 from tqdm import tqdm # Get the PsychoPy version currently in use
 
 import aes
+import dataset_key
+import encrypted_archive
+import results_journal
+
+OUTPUT_FORMATS = ('files', 'tar', 'zip')
+
+
+def decrypted_file_name(encrypted_name):
+    return Path(encrypted_name).with_suffix('').name
+
 
 def decrypt_file(work_package):
+    """Decrypts the file into the output directory, under a temporary name until it is complete"""
     encrypted_path, output_directory, bytes_password = work_package
-    with open(encrypted_path, 'rb') as fp:
-        file_bytes = fp.read()
-        decrypted_file = aes.decrypt(bytes_password, file_bytes)
-        
-        with open(output_directory / encrypted_path.with_suffix('').name, 'wb') as out_fp:
-            out_fp.write(decrypted_file)
+    output_file = output_directory / decrypted_file_name(encrypted_path.name)
+    tmp_file = output_file.with_name(output_file.name + '.tmp')
+    try:
+        with open(encrypted_path, 'rb') as fp:
+            with open(tmp_file, 'wb') as out_fp:
+                aes.decrypt_stream(bytes_password, fp, out_fp)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
     return encrypted_path
-    
+
+
+def decrypt_to_bytes(work_package):
+    """Returns the name, modification time and decrypted bytes of a file or an archive entry"""
+    name, source, bytes_password = work_package
+    if isinstance(source, tuple):
+        archive_path, offset, length = source
+        encrypted_bytes = encrypted_archive.read_entry(archive_path, offset, length)
+        mtime = archive_path.stat().st_mtime
+    else:
+        encrypted_bytes = source.read_bytes()
+        mtime = source.stat().st_mtime
+    return name, mtime, aes.decrypt(bytes_password, encrypted_bytes)
+
+
+def ordered_imap(pool, function, work_packages, max_pending):
+    """Like pool.imap, but with at most max_pending results waiting, so a slow consumer bounds memory use"""
+    pending = deque()
+    for work_package in work_packages:
+        pending.append(pool.apply_async(function, (work_package,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_name_list(list_file):
+    with open(list_file) as fp:
+        return {line.strip() for line in fp if line.strip()}
+
+
+def read_annotated(results_file):
+    """Names of the annotated files in a results workbook or journal"""
+    results_file = Path(results_file)
+    if results_file.suffix == '.jsonl':
+        return set(results_journal.read_journal(results_file))
+    return set(results_journal.read_results_workbook(results_file))
+
+
+def matches(encrypted_name, names):
+    """Names may be given with or without the .enc suffix"""
+    return encrypted_name in names or decrypted_file_name(encrypted_name) in names
+
+
+def select_files(encrypted_names, patterns=None, name_list=None, skip_names=None, only_names=None):
+    """Filters the names of the encrypted files, a name has to pass every given filter"""
+    selected = []
+    for name in encrypted_names:
+        if patterns and not any(fnmatch(name, pattern) or fnmatch(decrypted_file_name(name), pattern) for pattern in patterns):
+            continue
+        if name_list is not None and not matches(name, name_list):
+            continue
+        if skip_names is not None and matches(name, skip_names):
+            continue
+        if only_names is not None and not matches(name, only_names):
+            continue
+        selected.append(name)
+    return selected
+
+
+def read_password(prompt):
+    # The prompt goes to stderr, since stdout may be the output stream
+    print(prompt, end='', file=sys.stderr, flush=True)
+    return input()
+
+
+def open_output_stream(output, output_format):
+    """Returns an open tar or zip file writing to the output path, or to stdout if it is '-'"""
+    fileobj = sys.stdout.buffer if str(output) == '-' else open(output, 'wb')
+    if output_format == 'tar':
+        # Stream mode, so stdout needs no seeking
+        return tarfile.open(fileobj=fileobj, mode='w|'), fileobj
+    # The images are already compressed
+    return zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_STORED), fileobj
+
+
+def add_to_stream(stream, name, mtime, data):
+    if isinstance(stream, tarfile.TarFile):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        info.mode = 0o644
+        stream.addfile(info, io.BytesIO(data))
+    else:
+        stream.writestr(zipfile.ZipInfo(name, time.localtime(mtime)[:6]), data)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('encrypted_dir', type=Path)
-    parser.add_argument('decryption_dir', type=Path)
+    parser.add_argument('output', type=Path, help="directory to decrypt the files to, or for tar and zip the file to write, '-' for stdout")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='files', help="write one file per image, or stream them into a tar or zip file")
+    parser.add_argument('--include', action='append', metavar='GLOB', help="only decrypt files whose name matches, may be given several times")
+    parser.add_argument('--list', type=Path, help="only decrypt the files named in this file, one name per line")
+    parser.add_argument('--skip_annotated', type=Path, metavar='RESULTS', help="skip files annotated in this results workbook or journal")
+    parser.add_argument('--only_annotated', type=Path, metavar='RESULTS', help="only decrypt files annotated in this results workbook or journal")
+    parser.add_argument('--skip_existing', action='store_true', help="skip files which have already been decrypted to the output directory")
+    parser.add_argument('--processes', type=int, default=None, help="number of decrypting processes (default: number of CPUs)")
     args = parser.parse_args()
-    
-    data_files = sorted([file for file in args.encrypted_dir.iterdir() if '.enc' == file.suffix])
-    password = input("Please enter decryption key:")
+
+    archive_path = args.encrypted_dir / encrypted_archive.ARCHIVE_FILE_NAME
+    password = read_password("Please enter decryption key:")
     bytes_password = bytes(password, encoding='utf8')
-    work_packages = [(Path(encrypted_path), args.decryption_dir, bytes_password) for encrypted_path in data_files]
-    args.decryption_dir.mkdir(exist_ok=True, parents=True)
-    with multiprocessing.Pool() as pool:
-        for path in tqdm(pool.imap_unordered(decrypt_file, work_packages), desc="Decrypting files", total=len(data_files)):
-            pass
+    try:
+        key_matches = dataset_key.check_password(args.encrypted_dir, bytes_password)
+    except AssertionError:
+        sys.exit(f"{args.encrypted_dir / aes.KEYCHECK_FILE_NAME} is not a valid keycheck file")
+    if not key_matches:
+        sys.exit(f"The key could not decrypt the data in {args.encrypted_dir}")
+
+    if archive_path.exists():
+        with encrypted_archive.ArchiveReader(archive_path, bytes_password) as archive:
+            sources = {name: (archive_path, *archive.entry(name)) for name in archive.names()}
+    else:
+        sources = {file.name: file for file in args.encrypted_dir.iterdir() if '.enc' == file.suffix}
+    selected = select_files(sorted(sources), args.include,
+                            read_name_list(args.list) if args.list is not None else None,
+                            read_annotated(args.skip_annotated) if args.skip_annotated is not None else None,
+                            read_annotated(args.only_annotated) if args.only_annotated is not None else None)
+    if args.skip_existing and args.format == 'files':
+        selected = [name for name in selected if not (args.output / decrypted_file_name(name)).exists()]
+    print(f"Decrypting {len(selected)} of {len(sources)} files", file=sys.stderr)
+
+    with multiprocessing.Pool(args.processes) as pool:
+        if args.format == 'files' and not archive_path.exists():
+            args.output.mkdir(exist_ok=True, parents=True)
+            work_packages = [(sources[name], args.output, bytes_password) for name in selected]
+            for path in tqdm(pool.imap_unordered(decrypt_file, work_packages), desc="Decrypting files", total=len(selected)):
+                pass
+        else:
+            work_packages = [(name, sources[name], bytes_password) for name in selected]
+            results = ordered_imap(pool, decrypt_to_bytes, work_packages, 2*(args.processes or os.cpu_count()))
+            if args.format == 'files':
+                args.output.mkdir(exist_ok=True, parents=True)
+                for name, mtime, data in tqdm(results, desc="Decrypting files", total=len(selected)):
+                    output_file = args.output / decrypted_file_name(name)
+                    tmp_file = output_file.with_name(output_file.name + '.tmp')
+                    tmp_file.write_bytes(data)
+                    os.replace(tmp_file, output_file)
+            else:
+                stream, fileobj = open_output_stream(args.output, args.format)
+                with stream:
+                    for name, mtime, data in tqdm(results, desc="Decrypting files", total=len(selected)):
+                        add_to_stream(stream, decrypted_file_name(name), mtime, data)
+                fileobj.flush()
+                if fileobj is not sys.stdout.buffer:
+                    fileobj.close()
 
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
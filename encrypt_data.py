@@ -52,13 +52,13 @@ def cover(
     return image.resize(size, resample=method)
 
 def encrypt_file(work_package):
-    image_path, output_directory, bytes_password, format, = work_package
+    image_path, output_directory, bytes_password, format, dataset_salt = work_package
     #print(f"Encrypting {path}")
     pil_image = Image.open(image_path).convert("RGB")
     pil_image = cover(pil_image, target_size)
     output_buffer = io.BytesIO()
     pil_image.save(output_buffer, format=format)
-    encrypted_file = aes.encrypt(bytes_password, output_buffer.getvalue())
+    encrypted_file = aes.encrypt(bytes_password, output_buffer.getvalue(), dataset_salt=dataset_salt)
     with open(output_directory / image_path.with_suffix(f'.{format}').name, 'wb') as out_fp:
         out_fp.write(encrypted_file)
     #print(f"Done encrypting {path}")
@@ -112,7 +112,9 @@ def main():
         bytes_password = bytes(password, encoding='utf8')
         with multiprocessing.Pool() as pool:
             format = 'jpeg'
-            work_packages = [(image_path, output_directory, bytes_password, format) for image_path in data_files]
+            # All files of this run share one key stretch, see the aes module docstring
+            dataset_salt = os.urandom(aes.SALT_SIZE)
+            work_packages = [(image_path, output_directory, bytes_password, format, dataset_salt) for image_path in data_files]
             for path in tqdm(pool.imap_unordered(encrypt_file, work_packages), desc="Encrypting files", total=len(data_files)):
                 pass
             
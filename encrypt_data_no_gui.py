@@ -9,61 +9,60 @@ import sys
 from pathlib import Path
 import io
 import os
+import time
+import hashlib
+import json
+import queue
+import threading
+import functools
+import contextlib
 from typing import Tuple
+from collections import defaultdict, namedtuple
 
-from PIL import Image, UnidentifiedImageError, ImageOps
+from PIL import Image, UnidentifiedImageError
 
 from tqdm import tqdm
-import numpy as np
 
 import aes
+import encrypted_archive
 
 target_size = (1200, 400)
+DRAFT_REDUCING_GAP = 2.0  # Large images are decoded to at least this many times the output size before the final resize
+TIMED_STAGES = ('decode', 'resize', 'composite', 'encode', 'encrypt')
+MANIFEST_FILE_NAME = 'dataset.manifest'
+MANIFEST_SAVE_INTERVAL = 30  # Seconds between saves of the manifest while encrypting, so an interrupted run can resume
 
-def alpha_composite(front, back):
-    """Alpha composite two RGBA images.
-
-    Source: http://stackoverflow.com/a/9166671/284318
-
-    Keyword Arguments:
-    front -- PIL RGBA Image object
-    back -- PIL RGBA Image object
-
-    """
-    front = np.asarray(front)
-    back = np.asarray(back)
-    result = np.empty(front.shape, dtype='float')
-    alpha = np.index_exp[:, :, 3:]
-    rgb = np.index_exp[:, :, :3]
-    falpha = front[alpha] / 255.0
-    balpha = back[alpha] / 255.0
-    result[alpha] = falpha + balpha * (1 - falpha)
-    old_setting = np.seterr(invalid='ignore')
-    result[rgb] = (front[rgb] * falpha + back[rgb] * balpha * (1 - falpha)) / result[alpha]
-    np.seterr(**old_setting)
-    result[alpha] *= 255
-    np.clip(result, 0, 255)
-    # astype('uint8') maps np.nan and np.inf to 0
-    result = result.astype('uint8')
-    result = Image.fromarray(result, 'RGBA')
-    return result
-
+ENCRYPTED = 'encrypted'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'  # Not an image, recorded in the manifest so it is not read again
+FAILED = 'failed'  # Could not be processed this time, left out of the manifest so it is retried on the next run
+EncryptionResult = namedtuple('EncryptionResult', ['source', 'status', 'output', 'sha256', 'encrypted_bytes', 'skip_reason', 'timings'], 
+                              defaults=(None, None, None, None, None))
 
 def alpha_composite_with_color(image, color=(255, 255, 255)):
-    """Alpha composite an RGBA image with a single color image of the
-    specified color and the same size as the original image.
+    """Alpha composite an image with a single color image of the
+    specified color and the same size as the original image. Since the
+    background is opaque this is a blend with alpha as the mask, which PIL
+    does natively. Images without transparency are returned as they are.
 
     Keyword Arguments:
-    image -- PIL RGBA Image object
+    image -- PIL Image object
     color -- Tuple r, g, b (default 255, 255, 255)
 
     """
-    back = Image.new('RGBA', size=image.size, color=color + (255,))
-    return alpha_composite(image, back)
+    if image.mode not in ('RGBA', 'LA', 'PA', 'RGBa', 'La') and 'transparency' not in image.info:
+        return image
+    image = image.convert('RGBA')
+    mask = image.getchannel('A')
+    if mask.getextrema() == (255, 255):
+        return image
+    back = Image.new('RGB', size=image.size, color=color)
+    back.paste(image, mask=mask)
+    return back
 
 # For some reason this was missing from the ImageOps bundled with PIL in psychopy, including it from the sources here
 def cover(
-    image: Image.Image, size: Tuple[int, int], method: int = Image.Resampling.BICUBIC
+    image: Image.Image, size: Tuple[int, int], method: int = Image.BICUBIC
 ) -> Image.Image:
     """
     Returns a resized version of the image, so that the requested size is
@@ -73,7 +72,7 @@ def cover(
     :param size: The requested output size in pixels, given as a
                  (width, height) tuple.
     :param method: Resampling method to use. Default is
-                   :py:attr:`~PIL.Image.Resampling.BICUBIC`.
+                   :py:attr:`~PIL.Image.BICUBIC`.
                    See :ref:`concept-filters`.
     :return: An image.
     """
@@ -92,46 +91,421 @@ def cover(
                 size = (new_width, size[1])
     return image.resize(size, resample=method)
 
-def encrypt_file(work_package):
-    image_path, output_directory, bytes_password, format, = work_package
-    #print(f"Encrypting {path}")
-    pil_image = Image.open(image_path)
+def encrypted_file_name(image_path, format):
+    return image_path.with_suffix('').name + f'.{format}.enc'
+
+
+def scan_source_dir(source_dir: Path):
+    """Lists the files of the directory. Whether they are images is decided by the workers when they open them."""
+    with os.scandir(source_dir) as entries:
+        return sorted(Path(entry.path) for entry in entries if entry.is_file())
+
+
+def contained_size(image_size, size):
+    """The size ImageOps.contain resizes an image of image_size to"""
+    im_ratio = image_size[0] / image_size[1]
+    dest_ratio = size[0] / size[1]
+    if im_ratio > dest_ratio:
+        return size[0], round(image_size[1] / image_size[0] * size[0])
+    if im_ratio < dest_ratio:
+        return round(image_size[0] / image_size[1] * size[1]), size[1]
+    return size
+
+
+def open_source_image(image_path, size=target_size, timings=None):
+    """
+    Decodes the image resized to fit within size, returns (image, None) or (None, reason) if it could not be read 
+    as an image. JPEGs much larger than size are downscaled by the decoder, which skips most of the decoding work, 
+    to no less than DRAFT_REDUCING_GAP times the output size so the final resize still has the detail it needs.
+    """
+    t0 = time.perf_counter()
+    try:
+        pil_image = Image.open(image_path)
+        output_size = contained_size(pil_image.size, size)
+        draft = pil_image.draft(None, (round(output_size[0]*DRAFT_REDUCING_GAP), round(output_size[1]*DRAFT_REDUCING_GAP)))
+        pil_image.load()
+    except UnidentifiedImageError:
+        return None, "not a recognized image format"
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Corrupt image data is reported by the decoders as OSError or ValueError
+        return None, str(e)
+    t1 = time.perf_counter()
+    if pil_image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        # Palette images would otherwise be resized with nearest neighbour
+        has_alpha = 'A' in pil_image.getbands() or 'transparency' in pil_image.info
+        pil_image = pil_image.convert('RGBA' if has_alpha else 'RGB')
+    # A draft rounds the size up to whole pixels, the box is the part covering the original image
+    box = draft[1] if draft is not None else None
+    pil_image = pil_image.resize(output_size, Image.LANCZOS, box=box, reducing_gap=DRAFT_REDUCING_GAP)
+    if timings is not None:
+        timings['decode'] = t1 - t0
+        timings['resize'] = time.perf_counter() - t1
+    return pil_image, None
+
+
+def encrypt_image(pil_image, bytes_password, format, dataset_salt, out_fp, timings=None):
+    """Encrypts an image as returned by open_source_image"""
+    t0 = time.perf_counter()
     pil_image = alpha_composite_with_color(pil_image).convert('RGB')
-    pil_image = ImageOps.contain(pil_image, target_size)
+    t1 = time.perf_counter()
     output_buffer = io.BytesIO()
     pil_image.save(output_buffer, format=format)
-    encrypted_file = aes.encrypt(bytes_password, output_buffer.getvalue())
-    output_file = output_directory / (image_path.with_suffix('').name + f'.{format}.enc')
-    with open(output_file, 'wb') as fp:
-        fp.write(encrypted_file)
-    return output_file
+    output_buffer.seek(0)
+    t2 = time.perf_counter()
+    aes.encrypt_chunked_stream(bytes_password, output_buffer, out_fp, dataset_salt=dataset_salt)
+    if timings is not None:
+        timings['composite'] = t1 - t0
+        timings['encode'] = t2 - t1
+        timings['encrypt'] = time.perf_counter() - t2
 
 
-def filter_image_files(image_path):
-    #print(f"Encrypting {path}")
-    try:
-        image = Image.open(image_path)
-        return True
-    except UnidentifiedImageError:
+def encrypt_source(work_package):
+    """
+    Decodes, resizes, encodes and encrypts the bytes of a source file, returns an EncryptionResult with the encrypted 
+    bytes or the reason the source was skipped. Runs in the worker processes of IngestPipeline.
+    """
+    image_path, source_bytes, sha256, bytes_password, format, dataset_salt = work_package
+    timings = dict()
+    pil_image, skip_reason = open_source_image(io.BytesIO(source_bytes), timings=timings)
+    if pil_image is None:
+        return EncryptionResult(image_path, SKIPPED, None, sha256, skip_reason=skip_reason, timings=timings)
+    encrypted_buffer = io.BytesIO()
+    encrypt_image(pil_image, bytes_password, format, dataset_salt, encrypted_buffer, timings)
+    return EncryptionResult(image_path, ENCRYPTED, encrypted_file_name(image_path, format), sha256, 
+                            encrypted_buffer.getvalue(), timings=timings)
+
+
+def write_output(output_directory: Path, result):
+    """Writes the encrypted bytes under a temporary name first, so an interrupted run never leaves a partial file 
+    under the output name"""
+    output_file = output_directory / result.output
+    tmp_file = output_file.with_name(output_file.name + '.tmp')
+    tmp_file.write_bytes(result.encrypted_bytes)
+    os.replace(tmp_file, output_file)
+
+
+class IngestPipeline:
+    """
+    Encrypts source files in stages connected by bounded queues. Reader threads read and hash the sources, worker 
+    processes decode, resize, encode and encrypt them and writer threads store the results with `store_output`. At 
+    most queue_size items wait at each stage, which bounds memory use, and slow storage only stalls the processes 
+    once their queue has filled up. Sources whose hash is the known one are not processed. A source which cannot be 
+    read, or which a worker raises on, is FAILED, while an error storing an output stops the pipeline.
+    """
+    STAGES = ('read', 'process', 'write')
+    POLL_INTERVAL = 0.1  # Seconds between checks of whether the pipeline is stopping, while a thread waits
+
+    def __init__(self, bytes_password, format, dataset_salt, store_output, processes=None, read_threads=4, 
+                 write_threads=2, queue_size=None):
+        self.bytes_password = bytes_password
+        self.format = format
+        self.dataset_salt = dataset_salt
+        self.store_output = store_output
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.read_threads = read_threads
+        self.write_threads = write_threads
+        self.queue_size = queue_size if queue_size is not None else 2*self.processes
+        self.read_queue = queue.Queue(self.queue_size)
+        self.write_queue = queue.Queue(self.queue_size)
+        self.done_queue = queue.Queue()
+        self.processing = threading.BoundedSemaphore(self.queue_size)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.completed = {stage: 0 for stage in self.STAGES}
+        self.n_processing = 0
+        self.start_time = None
+        self.pool = None
+
+    def run(self, work):
+        """
+        Takes a list of (source path, known hash or None) and yields an EncryptionResult for each, in the order they 
+        are done. The threads are stopped and joined when the generator finishes, raises or is closed, so once it 
+        has `store_output` is no longer called.
+        """
+        self.start_time = time.time()
+        with multiprocessing.Pool(self.processes) as pool:
+            self.pool = pool
+            threads = ([threading.Thread(target=self._scan, args=(work,), daemon=True)] 
+                       + [threading.Thread(target=self._read, daemon=True) for _ in range(self.read_threads)] 
+                       + [threading.Thread(target=self._write, daemon=True) for _ in range(self.write_threads)])
+            for thread in threads:
+                thread.start()
+            try:
+                for _ in range(len(work)):
+                    result = self.done_queue.get()
+                    if isinstance(result, BaseException):
+                        raise result
+                    yield result
+            finally:
+                self.stopping.set()
+                for thread in threads:
+                    thread.join()
+
+    def status(self):
+        """Throughput and number of waiting items of each stage"""
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        waiting = {'read': self.read_queue.qsize(), 'process': self.n_processing, 'write': self.write_queue.qsize()}
+        return ", ".join(f"{stage} {self.completed[stage]/elapsed:.1f}/s [{waiting[stage]}]" for stage in self.STAGES)
+
+    def _count(self, stage):
+        with self.lock:
+            self.completed[stage] += 1
+
+    def _put(self, stage_queue, item):
+        """Puts the item on the bounded queue, returns False without doing so if the pipeline is stopping"""
+        while not self.stopping.is_set():
+            try:
+                stage_queue.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
         return False
+
+    def _get(self, stage_queue):
+        """Returns the next item of the queue, or None if the pipeline is stopping"""
+        while not self.stopping.is_set():
+            try:
+                return stage_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    def _scan(self, work):
+        for item in work:
+            if not self._put(self.read_queue, item):
+                return
+
+    def _read(self):
+        while True:
+            item = self._get(self.read_queue)
+            if item is None:
+                return
+            image_path, known_sha256 = item
+            try:
+                source_bytes = image_path.read_bytes()
+            except OSError as e:
+                # Possibly a passing error of e.g. a network share
+                self.done_queue.put(EncryptionResult(image_path, FAILED, skip_reason=str(e)))
+                continue
+            sha256 = hashlib.sha256(source_bytes).hexdigest()
+            self._count('read')
+            if sha256 == known_sha256:
+                self.done_queue.put(EncryptionResult(image_path, UNCHANGED, encrypted_file_name(image_path, self.format), sha256))
+                continue
+            while not self.processing.acquire(timeout=self.POLL_INTERVAL):
+                if self.stopping.is_set():
+                    return
+            with self.lock:
+                self.n_processing += 1
+            self.pool.apply_async(encrypt_source, 
+                                  ((image_path, source_bytes, sha256, self.bytes_password, self.format, self.dataset_salt),), 
+                                  callback=self._processed, error_callback=functools.partial(self._failed, image_path, sha256))
+
+    def _processed(self, result):
+        # Runs in the pool's result thread
+        with self.lock:
+            self.n_processing -= 1
+        self.processing.release()
+        self._count('process')
+        if result.status == ENCRYPTED:
+            self._put(self.write_queue, result)
+        else:
+            self.done_queue.put(result)
+
+    def _failed(self, image_path, sha256, error):
+        with self.lock:
+            self.n_processing -= 1
+        self.processing.release()
+        self._count('process')
+        # Not a problem of the image, e.g. a MemoryError, so it is not recorded as skipped
+        self.done_queue.put(EncryptionResult(image_path, FAILED, None, sha256, skip_reason=f"{type(error).__name__}: {error}"))
+
+    def _write(self):
+        while True:
+            result = self._get(self.write_queue)
+            if result is None:
+                return
+            try:
+                self.store_output(result)
+            except Exception as e:
+                self.done_queue.put(e)
+                continue
+            self._count('write')
+            self.done_queue.put(result._replace(encrypted_bytes=None))
+
+
+def load_manifest(output_directory: Path, bytes_password):
+    """
+    Returns the manifest entries of the output directory, a dict from source file name to the source's path, size, 
+    mtime and hash and the name, format and target size of its output. The manifest is encrypted since the hashes 
+    identify the source images.
+    """
+    manifest_file = output_directory / MANIFEST_FILE_NAME
+    if not manifest_file.exists():
+        return dict()
+    return json.loads(aes.decrypt(bytes_password, manifest_file.read_bytes()))['entries']
+
+
+def save_manifest(output_directory: Path, bytes_password, dataset_salt, entries):
+    manifest_file = output_directory / MANIFEST_FILE_NAME
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    tmp_file.write_bytes(aes.encrypt(bytes_password, json.dumps({'entries': entries}).encode('utf-8'), dataset_salt=dataset_salt))
+    os.replace(tmp_file, manifest_file)
+
+
+def manifest_entry(image_path, stat, format, result):
+    return {'source': str(image_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': result.sha256, 
+            'output': result.output, 'format': format, 'target_size': list(target_size)}
+
+
+def plan_work(data_files, entries, format, output_exists):
+    """
+    Compares the source files to the manifest. Returns the stat of every source and the files to process, with the 
+    known hash of those whose output is current apart from the source's size or mtime. Files with the same size and 
+    mtime as in the manifest and an existing output are not processed.
+    """
+    stats = dict()
+    to_process = []
+    for image_path in data_files:
+        stat = stats[image_path] = image_path.stat()
+        entry = entries.get(image_path.name)
+        if entry is None or entry['format'] != format or entry['target_size'] != list(target_size):
+            to_process.append((image_path, None))
+        elif entry['output'] is not None and not output_exists(entry['output']):
+            to_process.append((image_path, None))
+        elif entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            # Possibly only touched, the worker compares the hash before encrypting
+            to_process.append((image_path, entry['sha256'] if entry['output'] is not None else None))
+    return stats, to_process
+
+
+def get_dataset_salt(output_directory: Path, bytes_password):
+    """Returns the dataset salt of the output directory, creating a new one along with its keycheck file if the 
+    directory has none. Exits if the directory was encrypted with another key."""
+    keycheck_file = output_directory / aes.KEYCHECK_FILE_NAME
+    if keycheck_file.exists():
+        keycheck = keycheck_file.read_bytes()
+        try:
+            key_matches = aes.check_key(bytes_password, keycheck)
+        except AssertionError:
+            sys.exit(f"{keycheck_file} is not a valid keycheck file")
+        if not key_matches:
+            sys.exit(f"{output_directory} contains data encrypted with another key, use a different output directory")
+        return aes.get_keycheck_salt(keycheck)
+    dataset_salt = os.urandom(aes.SALT_SIZE)
+    keycheck_file.write_bytes(aes.create_keycheck(bytes_password, dataset_salt))
+    return dataset_salt
+
+
+def print_stage_timings(stage_timings):
+    """Prints the mean time per image of each stage, summed over the workers"""
+    encrypted = stage_timings.get('encrypt', [])
+    if encrypted:
+        print(f"Mean time per image over {len(encrypted)} images: " 
+              + ", ".join(f"{stage} {sum(stage_timings[stage])/len(stage_timings[stage]):.4f}s" 
+                          for stage in TIMED_STAGES if stage in stage_timings))
+
+
+def print_missing_summary(missing_entries, deleted):
+    if missing_entries:
+        action = "deleted their outputs" if deleted else "kept their outputs, use --delete_missing to delete them"
+        print(f"{len(missing_entries)} sources in the manifest no longer exist, {action}:")
+        for name in sorted(missing_entries):
+            print(f"  {missing_entries[name]['source']} -> {missing_entries[name]['output']}")
+
+
+def print_skipped_summary(skipped_files):
+    if skipped_files:
+        print(f"Skipped {len(skipped_files)} files which could not be read as images:")
+        for image_path, skip_reason in sorted(skipped_files):
+            print(f"  {image_path}: {skip_reason}")
+
+
+def print_failed_summary(failed_files):
+    if failed_files:
+        print(f"Failed to encrypt {len(failed_files)} files, they are tried again on the next run:", file=sys.stderr)
+        for image_path, reason in sorted(failed_files):
+            print(f"  {image_path}: {reason}", file=sys.stderr)
+
     
 def main():
     parser = argparse.ArgumentParser(description="Script to encrypt image data")
     parser.add_argument('source_dir', help="Directory with image files to encrypt", type=Path)
     parser.add_argument('--output_directory', help="directory to store encrypted data to", default=Path("encrypted_data"), type=Path)
+    parser.add_argument('--archive', help=f"pack the encrypted files into a single archive ({encrypted_archive.ARCHIVE_FILE_NAME}) in the output directory instead of one file per image", action='store_true')
+    parser.add_argument('--processes', help="number of processes decoding and encrypting images (default: number of CPUs)", type=int, default=None)
+    parser.add_argument('--read_threads', help="number of threads reading source files", type=int, default=4)
+    parser.add_argument('--write_threads', help="number of threads writing encrypted files, an archive is always written by one", type=int, default=2)
+    parser.add_argument('--queue_size', help="maximum number of images waiting at each stage (default: twice the number of processes)", type=int, default=None)
+    parser.add_argument('--delete_missing', help=f"delete the outputs of sources in the manifest ({MANIFEST_FILE_NAME}) which no longer exist, by default they are only listed", action='store_true')
     args = parser.parse_args()
     
     password = input("Please enter encryption key:")
     
-    data_files = [data_file for data_file in args.source_dir.iterdir() if filter_image_files(data_file)]
+    # Files are not probed here, the workers skip those which are not images
+    data_files = scan_source_dir(args.source_dir)
         
     bytes_password = bytes(password, encoding='utf8')
     args.output_directory.mkdir(exist_ok=True, parents=True)
-    with multiprocessing.Pool() as pool:
-        format = 'jpeg'
-        work_packages = [(image_path, args.output_directory, bytes_password, format) for image_path in sorted(data_files)]
-        for name in tqdm(pool.imap_unordered(encrypt_file, work_packages), desc="Encrypting files", total=len(data_files)):
-            pass
+    # All files of the dataset share one key stretch, see the aes module docstring
+    dataset_salt = get_dataset_salt(args.output_directory, bytes_password)
+    # Only new and changed sources are encrypted, the manifest records what the outputs were made from
+    entries = load_manifest(args.output_directory, bytes_password)
+    format = 'jpeg'
+    skipped_files = []
+    failed_files = []
+    stage_timings = defaultdict(list)
+    source_names = {image_path.name for image_path in data_files}
+    missing_entries = {name: entry for name, entry in entries.items() if name not in source_names}
+    
+    def process(output_exists, store_output, remove_output, write_threads, save_while_processing):
+        stats, to_process = plan_work(data_files, entries, format, output_exists)
+        print(f"{len(to_process)} of {len(data_files)} source files are new or changed")
+        pipeline = IngestPipeline(bytes_password, format, dataset_salt, store_output, args.processes, args.read_threads, 
+                                  write_threads, args.queue_size)
+        last_save = time.time()
+        # Closed explicitly, so the pipeline has stopped writing before the archive is closed, also on errors
+        with contextlib.closing(pipeline.run(to_process)) as results:
+            progress = tqdm(results, desc="Encrypting files", total=len(to_process))
+            for result in progress:
+                progress.set_postfix_str(pipeline.status(), refresh=False)
+                if result.status == FAILED:
+                    failed_files.append((result.source, result.skip_reason))
+                    continue
+                if result.status == SKIPPED:
+                    skipped_files.append((result.source, result.skip_reason))
+                entries[result.source.name] = manifest_entry(result.source, stats[result.source], format, result)
+                for stage, dt in (result.timings or dict()).items():
+                    stage_timings[stage].append(dt)
+                if save_while_processing and time.time() - last_save > MANIFEST_SAVE_INTERVAL:
+                    save_manifest(args.output_directory, bytes_password, dataset_salt, entries)
+                    last_save = time.time()
+        if args.delete_missing:
+            for name, entry in missing_entries.items():
+                if entry['output'] is not None:
+                    remove_output(entry['output'])
+                del entries[name]
+    
+    try:
+        if args.archive:
+            archive_path = args.output_directory / encrypted_archive.ARCHIVE_FILE_NAME
+            with encrypted_archive.ArchiveWriter(archive_path, bytes_password, dataset_salt) as archive:
+                # New entries are only in the archive index once it is closed, so the manifest is not saved while encrypting
+                process(archive.__contains__, lambda result: archive.add(result.output, result.encrypted_bytes), 
+                        archive.remove, 1, False)
+        else:
+            process(lambda name: (args.output_directory / name).exists(), 
+                    lambda result: write_output(args.output_directory, result),
+                    lambda name: (args.output_directory / name).unlink(missing_ok=True), args.write_threads, True)
+    finally:
+        # Saved also when interrupted, everything in the manifest has been written
+        save_manifest(args.output_directory, bytes_password, dataset_salt, entries)
+    print_stage_timings(stage_timings)
+    print_skipped_summary(skipped_files)
+    print_missing_summary(missing_entries, args.delete_missing)
+    print_failed_summary(failed_files)
+    if failed_files:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+"""
+Single-file archive of encrypted data files.
+
+An archive is `header + entries + index`. The header holds the position of
+the index, each entry is an encrypted message as written by `aes` (the same
+bytes a `.enc` file would contain) and the index is an `aes` encrypted JSON
+mapping of entry name to offset and length. Opening an archive therefore
+costs one open and one small decryption, after which every entry is a slice
+of a memory map of the file.
+"""
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+import aes
+
+ARCHIVE_FILE_NAME = 'dataset.archive'
+ARCHIVE_MAGIC = b'ACFA'
+ARCHIVE_VERSION = 1
+_ARCHIVE_HEADER = struct.Struct('>4sBQQ')  # magic, version, index offset, index length
+COMPACT_DEAD_FRACTION = 0.25  # An archive is rewritten on close if more than this fraction of it is no longer used
+
+
+class ArchiveReader:
+    """
+    Read access to the entries of an archive. The index is decrypted when the
+    archive is opened, which fails with an AssertionError for a wrong key.
+    """
+    def __init__(self, path, key, workload=100000):
+        self.path = Path(path)
+        self._fp = open(self.path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, index_offset, index_length = _ARCHIVE_HEADER.unpack_from(self._mmap)
+            assert magic == ARCHIVE_MAGIC and version == ARCHIVE_VERSION, f"{self.path} is not an archive."
+            index = json.loads(aes.decrypt(key, self._mmap[index_offset : index_offset + index_length], workload))
+        except Exception:
+            self.close()
+            raise
+        self.index_offset = index_offset
+        self.index_length = index_length
+        self._entries = {name: tuple(entry) for name, entry in index['entries'].items()}
+
+    def names(self):
+        return list(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entry(self, name):
+        """Returns the (offset, length) of the entry `name` in the archive."""
+        return self._entries[name]
+
+    def read(self, name):
+        """Returns the encrypted bytes of the entry `name`."""
+        offset, length = self._entries[name]
+        return self._mmap[offset : offset + length]
+
+    def close(self):
+        if getattr(self, '_mmap', None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchiveWriter:
+    """
+    Adds entries to an archive, creating it if needed. Entries added to an
+    existing archive replace entries with the same name. New entries and the
+    new index are appended after the old index, which stays valid until the
+    new one is on disk, so an interrupted writer leaves the archive as it was
+    when last closed. The index is only written if entries were added or
+    removed, and the space of replaced and removed entries is reclaimed by
+    rewriting the archive once it exceeds COMPACT_DEAD_FRACTION of the file.
+    """
+    def __init__(self, path, key, dataset_salt=None, workload=100000):
+        self.path = Path(path)
+        self.key = key
+        self.dataset_salt = dataset_salt
+        self.workload = workload
+        if not self.path.exists():
+            # Created empty under a temporary name, so the archive is always readable
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp_path, 'w+b') as fp:
+                fp.write(bytes(_ARCHIVE_HEADER.size))
+                self._write_index(fp, dict())
+            os.replace(tmp_path, self.path)
+        with ArchiveReader(self.path, key, workload) as reader:
+            self._entries = {name: reader.entry(name) for name in reader.names()}
+            self._index_length = reader.index_length
+        self._changed = False
+        self._fp = open(self.path, 'r+b')
+        self._fp.seek(0, os.SEEK_END)
+
+    def add(self, name, encrypted_bytes):
+        """Appends an encrypted message as the entry `name`."""
+        offset = self._fp.tell()
+        self._fp.write(encrypted_bytes)
+        self._entries[name] = (offset, len(encrypted_bytes))
+        self._changed = True
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def remove(self, name):
+        """Removes the entry `name` from the index, its bytes stay in the archive until it is compacted."""
+        if self._entries.pop(name, None) is not None:
+            self._changed = True
+
+    def dead_bytes(self):
+        """Bytes of the archive in no entry or the index, left by replaced and removed entries and old indices."""
+        size = self._fp.seek(0, os.SEEK_END)
+        return size - _ARCHIVE_HEADER.size - self._index_length - sum(length for offset, length in self._entries.values())
+
+    def close(self):
+        try:
+            if self._changed:
+                self._index_length = self._write_index(self._fp, self._entries)
+                self._changed = False
+            size = self._fp.seek(0, os.SEEK_END)
+            if self.dead_bytes() > COMPACT_DEAD_FRACTION * size:
+                self._compact()
+        finally:
+            self._fp.close()
+
+    def _compact(self):
+        """
+        Rewrites the archive with only its entries and index, under a
+        temporary name until it is complete.
+        """
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        entries = dict()
+        try:
+            with open(tmp_path, 'w+b') as fp:
+                fp.write(bytes(_ARCHIVE_HEADER.size))
+                for name, (offset, length) in self._entries.items():
+                    self._fp.seek(offset)
+                    entries[name] = (fp.tell(), length)
+                    fp.write(self._fp.read(length))
+                self._index_length = self._write_index(fp, entries)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self._entries = entries
+
+    def _write_index(self, fp, entries):
+        """Appends the index and only then points the header at it. Returns the length of the index."""
+        index = json.dumps({'entries': entries}).encode('utf-8')
+        encrypted_index = aes.encrypt(self.key, index, self.workload, dataset_salt=self.dataset_salt)
+        fp.seek(0, os.SEEK_END)
+        index_offset = fp.tell()
+        fp.write(encrypted_index)
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.seek(0)
+        fp.write(_ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, index_offset, len(encrypted_index)))
+        fp.flush()
+        os.fsync(fp.fileno())
+        return len(encrypted_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_open_archives = dict()
+
+def read_entry(archive_path, offset, length):
+    """
+    Returns the bytes at `offset` in the archive. Meant for pool workers: each
+    process keeps one memory map per archive instead of opening it per entry.
+    """
+    archive_path = str(archive_path)
+    if archive_path not in _open_archives:
+        with open(archive_path, 'rb') as fp:
+            _open_archives[archive_path] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return _open_archives[archive_path][offset : offset + length]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Changes the password of an encrypted dataset in place. Every message is
+decrypted and encrypted with the new password in memory, in parallel, so no
+plaintext is written to disk and the images are not decoded or compressed
+again. Files are replaced one at a time and the new keycheck is only put in
+place at the end. An interrupted run is resumed by running again with the
+same passwords, files already encrypted with the new password are skipped.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from pathlib import Path
+
+from tqdm import tqdm
+
+import aes
+import encrypted_archive
+from dataset_key import check_archive_key, check_password
+from encrypt_data_no_gui import MANIFEST_FILE_NAME
+
+PENDING_KEYCHECK_FILE_NAME = aes.KEYCHECK_FILE_NAME + '.new'
+# Enough of a message to hold its dataset salt, whatever its format version
+_MESSAGE_HEADER_SIZE = aes.HEADER_SIZE + aes.HMAC_SIZE + aes.SALT_SIZE
+
+
+def rekey_message(encrypted_bytes, old_password, new_password, new_dataset_salt):
+    """Returns the message encrypted with the new password, or None if it already is"""
+    # The dataset salt is random, only messages encrypted by this rekeying have the new one
+    if aes.get_dataset_salt(encrypted_bytes) == new_dataset_salt:
+        return None
+    plaintext = aes.decrypt(old_password, encrypted_bytes)
+    return aes.encrypt_chunked(new_password, plaintext, dataset_salt=new_dataset_salt)
+
+
+def rekey_file(work_package):
+    encrypted_path, old_password, new_password, new_dataset_salt = work_package
+    rekeyed_bytes = rekey_message(encrypted_path.read_bytes(), old_password, new_password, new_dataset_salt)
+    if rekeyed_bytes is not None:
+        tmp_path = encrypted_path.with_name(encrypted_path.name + '.tmp')
+        tmp_path.write_bytes(rekeyed_bytes)
+        os.replace(tmp_path, encrypted_path)
+    return encrypted_path
+
+
+def rekey_archive_entry(work_package):
+    name, archive_path, offset, length, old_password, new_password, new_dataset_salt = work_package
+    encrypted_bytes = encrypted_archive.read_entry(archive_path, offset, length)
+    rekeyed_bytes = rekey_message(encrypted_bytes, old_password, new_password, new_dataset_salt)
+    return name, rekeyed_bytes if rekeyed_bytes is not None else encrypted_bytes
+
+
+def read_dataset_salt(encrypted_path: Path):
+    with open(encrypted_path, 'rb') as fp:
+        return aes.get_dataset_salt(fp.read(_MESSAGE_HEADER_SIZE))
+
+
+def rekeying_started(encrypted_dir: Path, data_files, old_password, pending_dataset_salt):
+    """Returns True if anything in the dataset has been encrypted with the dataset salt of a pending keycheck"""
+    archive_path = encrypted_dir / encrypted_archive.ARCHIVE_FILE_NAME
+    manifest_file = encrypted_dir / MANIFEST_FILE_NAME
+    # The old password has been checked, so an archive it does not open has been rekeyed
+    if archive_path.exists() and not check_archive_key(archive_path, old_password):
+        return True
+    return any(read_dataset_salt(path) == pending_dataset_salt for path in data_files + [manifest_file] if path.exists())
+
+
+def get_pending_dataset_salt(encrypted_dir: Path):
+    """Returns the dataset salt of the keycheck of an interrupted run, or None if there is none"""
+    pending_keycheck_file = encrypted_dir / PENDING_KEYCHECK_FILE_NAME
+    if not pending_keycheck_file.exists():
+        return None
+    return aes.get_keycheck_salt(pending_keycheck_file.read_bytes())
+
+
+def get_new_dataset_salt(encrypted_dir: Path, old_password, new_password, data_files):
+    """
+    Returns the dataset salt of the new password, the one of an interrupted run if it used the same password. Exits 
+    if an interrupted run with another new password has already rekeyed part of the dataset, since those files 
+    can then only be decrypted with that password.
+    """
+    pending_keycheck_file = encrypted_dir / PENDING_KEYCHECK_FILE_NAME
+    if pending_keycheck_file.exists():
+        pending_keycheck = pending_keycheck_file.read_bytes()
+        if aes.check_key(new_password, pending_keycheck):
+            return aes.get_keycheck_salt(pending_keycheck)
+        if rekeying_started(encrypted_dir, data_files, old_password, aes.get_keycheck_salt(pending_keycheck)):
+            sys.exit(f"An interrupted run has already encrypted part of {encrypted_dir} with another new key. "
+                     f"Run again with that key as the new key to finish it, the key can be changed again afterwards.")
+    new_dataset_salt = os.urandom(aes.SALT_SIZE)
+    pending_keycheck_file.write_bytes(aes.create_keycheck(new_password, new_dataset_salt))
+    return new_dataset_salt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Script to change the password of encrypted data")
+    parser.add_argument('encrypted_dir', help="Directory with encrypted data, it is rekeyed in place", type=Path)
+    args = parser.parse_args()
+    
+    data_files = sorted([file for file in args.encrypted_dir.iterdir() if '.enc' == file.suffix])
+    old_password = bytes(input("Please enter current encryption key:"), encoding='utf8')
+    # Without a keycheck the key is checked against a file, which must be one an interrupted run has not rekeyed
+    pending_dataset_salt = get_pending_dataset_salt(args.encrypted_dir)
+    old_files = [path for path in data_files if pending_dataset_salt is None or read_dataset_salt(path) != pending_dataset_salt]
+    try:
+        key_matches = check_password(args.encrypted_dir, old_password, old_files)
+    except AssertionError:
+        sys.exit(f"{args.encrypted_dir / aes.KEYCHECK_FILE_NAME} is not a valid keycheck file")
+    if not key_matches:
+        sys.exit(f"The key could not decrypt the data in {args.encrypted_dir}")
+    new_password = bytes(input("Please enter new encryption key:"), encoding='utf8')
+    if new_password != bytes(input("Please repeat new encryption key:"), encoding='utf8'):
+        sys.exit("The new keys did not match")
+    new_dataset_salt = get_new_dataset_salt(args.encrypted_dir, old_password, new_password, data_files)
+    
+    with multiprocessing.Pool() as pool:
+        work_packages = [(encrypted_path, old_password, new_password, new_dataset_salt) for encrypted_path in data_files]
+        for path in tqdm(pool.imap_unordered(rekey_file, work_packages), desc="Rekeying files", total=len(data_files)):
+            pass
+        
+        archive_path = args.encrypted_dir / encrypted_archive.ARCHIVE_FILE_NAME
+        if archive_path.exists() and not check_archive_key(archive_path, new_password):
+            # The archive is written anew next to the old one, an interrupted run starts it over
+            with encrypted_archive.ArchiveReader(archive_path, old_password) as archive:
+                entries = [(name, *archive.entry(name)) for name in archive.names()]
+            tmp_archive_path = archive_path.with_name(archive_path.name + '.tmp')
+            tmp_archive_path.unlink(missing_ok=True)
+            work_packages = [(name, archive_path, offset, length, old_password, new_password, new_dataset_salt) 
+                             for name, offset, length in entries]
+            with encrypted_archive.ArchiveWriter(tmp_archive_path, new_password, new_dataset_salt) as new_archive:
+                for name, rekeyed_bytes in tqdm(pool.imap_unordered(rekey_archive_entry, work_packages), desc="Rekeying archive", total=len(entries)):
+                    new_archive.add(name, rekeyed_bytes)
+            os.replace(tmp_archive_path, archive_path)
+    
+    manifest_file = args.encrypted_dir / MANIFEST_FILE_NAME
+    if manifest_file.exists():
+        rekey_file((manifest_file, old_password, new_password, new_dataset_salt))
+    os.replace(args.encrypted_dir / PENDING_KEYCHECK_FILE_NAME, args.encrypted_dir / aes.KEYCHECK_FILE_NAME)
+
+
+if __name__ == '__main__':
+    main()
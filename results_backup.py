@@ -0,0 +1,106 @@
+"""
+Backup of every annotation event in a single SQLite database.
+
+Events are the confirmed annotations and every change of annotation before
+confirming. They are stored in one table indexed on file name, with the
+database in WAL mode so each event is a cheap append. The results workbook
+can be rebuilt from the backup in one pass by running this module:
+
+    python results_backup.py results_backup.sqlite partial_results.xlsx
+"""
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import results_journal
+
+ANNOTATION_EVENT = 'annotation'
+CHANGE_EVENT = 'change'
+
+
+class BackupStore:
+    """
+    The backup database at `path`, created if needed. The connection may be
+    used from another thread than the one that opened it, but only from one
+    thread at a time.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, time REAL, event TEXT, '
+                                     'file TEXT, annotation TEXT, n_changes INTEGER, decision_time REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS events_file ON events (file)')
+
+    def add(self, record, event=ANNOTATION_EVENT, timestamp=None):
+        """Stores an annotation record as an event of the given kind."""
+        self._insert([(timestamp if timestamp is not None else time.time(), event, record)])
+
+    def _insert(self, events):
+        with self._connection:
+            self._connection.executemany('INSERT INTO events (time, event, file, annotation, n_changes, decision_time) '
+                                         'VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(timestamp, event, *(record[fieldname] for fieldname in results_journal.FIELDNAMES))
+                                          for timestamp, event, record in events])
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def events(self, file_name):
+        """Returns all events for the file as (time, event, record) tuples in the order they happened."""
+        rows = self._connection.execute('SELECT time, event, file, annotation, n_changes, decision_time FROM events '
+                                        'WHERE file = ? ORDER BY id', (file_name,))
+        return [(timestamp, event, dict(zip(results_journal.FIELDNAMES, values))) for timestamp, event, *values in rows]
+
+    def lookup(self, file_name):
+        """Returns the last confirmed annotation record of the file, or None if it has not been annotated."""
+        row = self._connection.execute('SELECT file, annotation, n_changes, decision_time FROM events '
+                                       'WHERE file = ? AND event = ? ORDER BY id DESC LIMIT 1',
+                                       (file_name, ANNOTATION_EVENT)).fetchone()
+        return dict(zip(results_journal.FIELDNAMES, row)) if row is not None else None
+
+    def annotations(self):
+        """Returns the last confirmed annotation of every file, as a dict of file name to record."""
+        rows = self._connection.execute('SELECT file, annotation, n_changes, decision_time FROM events '
+                                        'WHERE event = ? ORDER BY id', (ANNOTATION_EVENT,))
+        return {row[0]: dict(zip(results_journal.FIELDNAMES, row)) for row in rows}
+
+    def import_json_directory(self, directory):
+        """
+        Adds the one JSON file per annotation backups written by earlier versions of the program. Files which can't
+        be read as an annotation record are skipped, they are returned as a list of (path, reason).
+        """
+        events = []
+        skipped = []
+        for backup_file in Path(directory).glob('*.json'):
+            try:
+                with open(backup_file) as fp:
+                    record = json.load(fp)
+                if not isinstance(record, dict) or not all(fieldname in record for fieldname in results_journal.FIELDNAMES):
+                    raise ValueError("not an annotation record")
+                events.append((backup_file.stat().st_mtime, ANNOTATION_EVENT, record))
+            except (OSError, ValueError) as e:
+                skipped.append((backup_file, str(e)))
+        events.sort(key=lambda event: event[0])
+        self._insert(events)
+        return skipped
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(f"Usage: {sys.argv[0]} BACKUP WORKBOOK")
+    with BackupStore(sys.argv[1]) as backup:
+        results_journal.write_results_workbook(backup.annotations(), sys.argv[2])
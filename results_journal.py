@@ -0,0 +1,274 @@
+"""
+Append-only journal of annotation results.
+
+Every annotation is appended to the journal as one JSON line and fsynced, so
+saving a result costs the same however many annotations have been made. The
+journal is replayed on resume, later lines for a file replace earlier ones.
+The Excel workbook is only written from the annotations when needed, e.g. at
+pauses and on exit, together with a compact snapshot of the annotations so a
+resume only replays the part of the journal written after it. `ResultsWriter`
+does all of this in a background thread so saving never delays the next
+trial. A journal can also be converted by running this module:
+
+    python results_journal.py partial_results.jsonl partial_results.xlsx
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+
+import openpyxl
+
+import results_backup
+
+FIELDNAMES = ['file', 'annotation', 'n_changes', 'decision_time']
+MAX_PENDING_WRITES = 64
+
+
+class ResultsJournal:
+    """Appends annotation records to the journal at `path`, creating it if needed."""
+    def __init__(self, path):
+        self.path = Path(path)
+        incomplete_line = False
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with open(self.path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                incomplete_line = fp.read(1) != b'\n'
+        self._fp = open(self.path, 'a', encoding='utf-8')
+        if incomplete_line:
+            # Left by a crash while writing, start the next record on a line of its own
+            self._fp.write('\n')
+
+    def append(self, record):
+        """Writes the record and returns once it is on disk."""
+        self.extend([record])
+
+    def extend(self, records):
+        for record in records:
+            self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def tell(self):
+        """The size of the journal, which is where the next record will be written."""
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def snapshot_path(journal_path):
+    return Path(journal_path).with_suffix('.snapshot.json')
+
+
+def write_snapshot(annotations, journal_path, journal_offset):
+    """Writes the annotations, which must be those in the first `journal_offset` bytes of the journal, to its snapshot."""
+    path = snapshot_path(journal_path)
+    snapshot = {'journal_offset': journal_offset,
+                'annotations': [[record[fieldname] for fieldname in FIELDNAMES] for record in annotations.values()]}
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        json.dump(snapshot, fp, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(journal_path):
+    """Returns the annotations and journal offset of the journal's snapshot, or None if it has none matching the journal."""
+    path = snapshot_path(journal_path)
+    if not path.exists():
+        return None
+    try:
+        with open(path, encoding='utf-8') as fp:
+            snapshot = json.load(fp)
+    except json.JSONDecodeError:
+        return None
+    journal_offset = snapshot['journal_offset']
+    if journal_offset > Path(journal_path).stat().st_size:
+        return None
+    if journal_offset > 0:
+        # The snapshot ends where a record does, otherwise the journal has been replaced
+        with open(journal_path, 'rb') as fp:
+            fp.seek(journal_offset - 1)
+            if fp.read(1) != b'\n':
+                return None
+    annotations = {row[0]: dict(zip(FIELDNAMES, row)) for row in snapshot['annotations']}
+    return annotations, journal_offset
+
+
+def read_journal(path, annotations=None, offset=0):
+    """
+    Replays the journal at `path` from byte `offset` and returns the
+    annotations as a dict of file name to record. If `annotations` is given
+    the journal is replayed on top of it.
+    """
+    annotations = dict() if annotations is None else annotations
+    with open(path, encoding='utf-8') as fp:
+        fp.seek(offset)
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line is incomplete if the program was killed while writing it
+                continue
+            annotations[record['file']] = record
+    return annotations
+
+
+def read_results_workbook(path):
+    """Reads annotations from a workbook written by `write_results_workbook`, or by earlier versions of the program."""
+    annotations = dict()
+    wb = openpyxl.load_workbook(filename=path, read_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        next(rows, None)  # We assume the first row is the header
+        for row in rows:
+            record = dict(zip(FIELDNAMES, row))
+            annotations[record['file']] = record
+    finally:
+        wb.close()
+    return annotations
+
+
+def write_results_workbook(annotations, path):
+    """Writes the annotations to the workbook at `path`. The old workbook is only replaced once the new one is complete."""
+    path = Path(path)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(FIELDNAMES)
+    for record in annotations.values():
+        ws.append([record[fieldname] for fieldname in FIELDNAMES])
+    tmp_path = path.with_suffix('.tmp' + path.suffix)
+    wb.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_annotations(journal_path, workbook_path):
+    """
+    Returns the annotations saved so far. If there is no journal but a
+    workbook from an earlier version of the program, its annotations are
+    copied to a new journal.
+    """
+    journal_path = Path(journal_path)
+    if journal_path.exists():
+        snapshot = read_snapshot(journal_path)
+        if snapshot is not None:
+            return read_journal(journal_path, *snapshot)
+        return read_journal(journal_path)
+    annotations = dict()
+    if Path(workbook_path).exists():
+        annotations = read_results_workbook(workbook_path)
+        with ResultsJournal(journal_path) as journal:
+            journal.extend(annotations.values())
+    return annotations
+
+
+def delete_annotations(journal_path, workbook_path):
+    """Removes the journal, its snapshot and the workbook."""
+    for path in (Path(journal_path), snapshot_path(journal_path), Path(workbook_path)):
+        path.unlink(missing_ok=True)
+
+
+class ResultsWriter:
+    """
+    Saves results in a background thread, in the order they were submitted.
+    Records go to the journal and, if `backup_store` is given, to that
+    `results_backup.BackupStore` which is then closed with the writer. At most `max_pending` writes are queued, after which
+    submitting blocks until the disk has caught up. Everything submitted is
+    written before `close` returns, which also happens when the interpreter
+    exits, e.g. on `core.quit()` or an unhandled exception. Errors in the
+    thread are raised by the next call.
+    """
+    def __init__(self, journal_path, workbook_path, backup_store=None, max_pending=MAX_PENDING_WRITES):
+        self.journal = ResultsJournal(journal_path)
+        self.workbook_path = Path(workbook_path)
+        self.backup_store = backup_store
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ResultsWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, record):
+        self._submit(self._write_record, record)
+
+    def append_change(self, record):
+        """Backs up a change of annotation which has not been confirmed yet."""
+        if self.backup_store is not None:
+            self._submit(self.backup_store.add, record, results_backup.CHANGE_EVENT, time.time())
+
+    def save_workbook(self, annotations, path=None):
+        """
+        Writes the annotations to the workbook, by default the one given when
+        creating the writer. In that case the annotations must be all those
+        appended, and they are also written to the journal's snapshot.
+        """
+        if path is None:
+            self._submit(self._write_workbook_and_snapshot, dict(annotations))
+        else:
+            self._submit(write_results_workbook, dict(annotations), path)
+
+    def flush(self):
+        """Waits until everything submitted so far has been written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self.journal.close()
+            if self.backup_store is not None:
+                self.backup_store.close()
+            atexit.unregister(self.close)
+        self._raise_error()
+
+    def _submit(self, function, *args):
+        assert not self._closed, "The results writer is closed."
+        self._raise_error()
+        self._queue.put((function, args))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_workbook_and_snapshot(self, annotations):
+        write_snapshot(annotations, self.journal.path, self.journal.tell())
+        write_results_workbook(annotations, self.workbook_path)
+
+    def _write_record(self, record):
+        self.journal.append(record)
+        if self.backup_store is not None:
+            self.backup_store.add(record, results_backup.ANNOTATION_EVENT, time.time())
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            try:
+                if work is None:
+                    return
+                function, args = work
+                function(*args)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(f"Usage: {sys.argv[0]} JOURNAL WORKBOOK")
+    write_results_workbook(read_journal(sys.argv[1]), sys.argv[2])
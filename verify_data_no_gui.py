@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks the integrity of an encrypted dataset without decrypting it. The
+HMACs of every file, or every entry of the archive, are checked in parallel,
+which needs no AES and writes nothing. Files which are truncated, corrupt,
+encrypted with another key or cannot be read at all are reported. `verify_dataset` is also used by
+acroface_annotate.py before a session starts.
+"""
+import argparse
+import multiprocessing
+import struct
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+from tqdm import tqdm
+
+import aes
+import encrypted_archive
+
+TRUNCATED = 'truncated'
+CORRUPT = 'corrupt'
+WRONG_KEY = 'encrypted with another key'
+CORRUPT_OR_WRONG_KEY = 'corrupt or encrypted with another key'
+UNREADABLE = 'unreadable'
+
+
+def check_message(encrypted_bytes, key, dataset_salt=None):
+    """
+    Returns None if the message is authentic under key, otherwise what is wrong with it. If the key has been checked 
+    against the keycheck of the dataset, its salt tells messages of other datasets apart from corrupt ones.
+    """
+    message_salt = aes.get_dataset_salt(encrypted_bytes)
+    if message_salt is not None and len(message_salt) < aes.SALT_SIZE:
+        return TRUNCATED
+    if dataset_salt is not None and message_salt is not None and message_salt != dataset_salt:
+        return WRONG_KEY
+    try:
+        aes.authenticate(key, encrypted_bytes)
+    except aes.TruncatedError:
+        return TRUNCATED
+    except aes.DecryptionError:
+        if dataset_salt is not None and message_salt is not None:
+            return CORRUPT
+        return CORRUPT_OR_WRONG_KEY
+    return None
+
+
+def verify_file(work_package):
+    encrypted_path, key, dataset_salt = work_package
+    try:
+        encrypted_bytes = encrypted_path.read_bytes()
+    except OSError:
+        return encrypted_path.name, UNREADABLE
+    return encrypted_path.name, check_message(encrypted_bytes, key, dataset_salt)
+
+
+def verify_archive_entry(work_package):
+    name, archive_path, offset, length, key, dataset_salt = work_package
+    try:
+        encrypted_bytes = encrypted_archive.read_entry(archive_path, offset, length)
+    except (OSError, ValueError):
+        return name, UNREADABLE
+    return name, check_message(encrypted_bytes, key, dataset_salt)
+
+
+def verify_dataset(encrypted_dir: Path, key, names=None, processes=None, progress=False):
+    """
+    Verifies the files of the dataset, or the entries of its archive if it has one, and returns a dict from the 
+    name of every file with a problem to the problem. If names is given only those files are verified.
+    """
+    keycheck_file = encrypted_dir / aes.KEYCHECK_FILE_NAME
+    dataset_salt = None
+    if keycheck_file.exists():
+        try:
+            keycheck = keycheck_file.read_bytes()
+        except OSError:
+            return {keycheck_file.name: UNREADABLE}
+        try:
+            if not aes.check_key(key, keycheck):
+                return {keycheck_file.name: WRONG_KEY}
+        except AssertionError:
+            return {keycheck_file.name: CORRUPT}
+        dataset_salt = aes.get_keycheck_salt(keycheck)
+    
+    archive_path = encrypted_dir / encrypted_archive.ARCHIVE_FILE_NAME
+    if archive_path.exists():
+        try:
+            archive = encrypted_archive.ArchiveReader(archive_path, key)
+        except aes.TruncatedError:
+            return {archive_path.name: TRUNCATED}
+        except AssertionError:
+            return {archive_path.name: CORRUPT_OR_WRONG_KEY}
+        except (OSError, ValueError, struct.error):
+            # A damaged header or index, or an archive which could not be read at all
+            return {archive_path.name: UNREADABLE}
+        with archive:
+            work_packages = [(name, archive_path, *archive.entry(name), key, dataset_salt) 
+                             for name in archive.names() if names is None or name in names]
+        verify_function = verify_archive_entry
+    else:
+        work_packages = [(encrypted_path, key, dataset_salt) for encrypted_path in sorted(encrypted_dir.iterdir()) 
+                         if encrypted_path.suffix == '.enc' and (names is None or encrypted_path.name in names)]
+        verify_function = verify_file
+    
+    problems = dict()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap_unordered(verify_function, work_packages, chunksize=8)
+        if progress:
+            results = tqdm(results, desc="Verifying files", total=len(work_packages))
+        for name, problem in results:
+            if problem is not None:
+                problems[name] = problem
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Script to check encrypted data for corrupt files, without decrypting it")
+    parser.add_argument('encrypted_dir', type=Path)
+    parser.add_argument('--processes', help="number of processes checking files (default: number of CPUs)", type=int, default=None)
+    args = parser.parse_args()
+    
+    password = input("Please enter decryption key:")
+    bytes_password = bytes(password, encoding='utf8')
+    problems = verify_dataset(args.encrypted_dir, bytes_password, processes=args.processes, progress=True)
+    if not problems:
+        print("All files are intact")
+        return
+    files_by_problem = defaultdict(list)
+    for name, problem in problems.items():
+        files_by_problem[problem].append(name)
+    for problem, names in sorted(files_by_problem.items()):
+        print(f"{len(names)} files are {problem}:")
+        for name in sorted(names):
+            print(f"  {name}")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()